@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pyvisa
+
+from rtb2002 import oscillograph
+from rtb2002_sim import simulator
+
+
+#####################################################################
+# Compare Vpp search on host ('LOOP') with measurement statistics
+# of oscilloscope ('STAT')
+#####################################################################
+def benchVoltagePP(scope, session, channel, bandwidth='20', htime=0.001, count=50):
+
+    results = {}
+
+    for mode in ('LOOP', 'STAT'):
+
+        start = time.perf_counter()
+        vpp = scope.getVoltagePP(session, channel, bandwidth, htime, mode, count)
+        results[mode] = (vpp, time.perf_counter() - start)
+
+    print("\nMode    Vpp, mV     Time, s")
+
+    for mode, (vpp, elapsed) in results.items():
+        print("{0:<7} {1:>8} {2:>11.3f}".format(mode, vpp, elapsed))
+
+    return results
+
+
+#####################################################################
+# Compare sustained captures per second of sequential single
+# acquisitions with pipelined ones (pipelineAcquisitions)
+# Both read header once and only CHAN:DATA? per record, so the
+# difference is overlap of transfer and processing
+# - work - processing time of every record in s
+#####################################################################
+def benchPipeline(scope, session, channel=1, count=50, work=0.005, data_format='UINT,8'):
+
+    def process(index, xtime, volts):
+        volts.max() - volts.min()
+        time.sleep(work)
+
+    scope.setChannelState(session, channel, 1)
+    scope._write(session, 'FORM '+data_format+';:FORM:BORD LSBF')
+
+    head = scope.getWaveformHeader(session, channel, data_format)
+
+    xtime = np.arange(head['points'], dtype=np.float64)
+    xtime *= (head['xstop'] - head['xstart']) / head['points']
+    xtime += head['xstart']
+
+    raw = np.zeros(head['points'] * head['values'], scope.WAVEFORM_FORMATS[data_format])
+
+    start = time.perf_counter()
+
+    for index in range(count):
+        scope.acquireSingle(session)
+        scope._write(session, 'CHAN'+str(channel)+':DATA?')
+        scope._readBlockInto(session, raw)
+        volts = raw * head['yincrement'] + head['yorigin']
+        process(index, xtime, volts)
+
+    sequential = count / (time.perf_counter() - start)
+
+    pipelined = scope.pipelineAcquisitions(session, channel, count, process, data_format)['rate']
+
+    print("\nMode          Captures/s")
+    print("{0:<13} {1:>10.1f}".format('SEQUENTIAL', sequential))
+    print("{0:<13} {1:>10.1f}".format('PIPELINE', pipelined))
+
+    return sequential, pipelined
+
+
+#####################################################################
+# Compare per-query latency and bulk waveform throughput of VXI-11,
+# raw socket and HiSLIP transports
+#####################################################################
+def benchTransports(scope, ipaddress, channel=1, count=100):
+
+    results = {}
+
+    for transport in ('INSTR', 'SOCKET', 'HISLIP'):
+
+        session = scope.connect(ipaddress, transport)
+
+        if session is None:
+            continue
+
+        # HiSLIP fell back to VXI-11, which is measured already
+        if transport == 'HISLIP' and 'hislip' not in session.resource_name.lower():
+            session.close()
+            continue
+
+        latency = []
+
+        for i in range(count):
+            start = time.perf_counter()
+            session.query('*IDN?')
+            latency.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        xtime, volts = scope.getWaveform(session, channel, 'UINT,8')
+        elapsed = time.perf_counter() - start
+
+        results[transport] = (session.resource_name, statistics.median(latency), max(latency), volts.size / elapsed)
+
+        session.close()
+
+    print("\nTransport Resource                                Median, ms   Max, ms   Throughput, MB/s")
+
+    for transport, (resource, median, worst, throughput) in results.items():
+        print("{0:<9} {1:<39} {2:>10.3f} {3:>9.3f} {4:>18.2f}".format(transport, resource, median * 1000, worst * 1000, throughput / 1e6))
+
+    return results
+
+
+#####################################################################
+# Round trips, bytes and wall time of high-level methods on simulated
+# oscilloscope
+#####################################################################
+def benchMethods(sim, scope, session, channel=1, repeat=3):
+
+    screen_name = os.path.join(tempfile.gettempdir(), 'bench_rtb2002.png')
+
+    methods = [
+        ('getVoltage', lambda: scope.getVoltage(session, channel)),
+        ('getVoltagePP STAT', lambda: scope.getVoltagePP(session, channel, '20', 0.00001, 'STAT')),
+        ('getVoltagePP LOOP', lambda: scope.getVoltagePP(session, channel, '20', 0.00001, 'LOOP')),
+        ('getVoltageDC', lambda: scope.getVoltageDC(session, channel, '20', 0.00001, 0.5)),
+        ('getScreenshot', lambda: scope.getScreenshot(session, screen_name)),
+    ]
+
+    results = {}
+
+    scpi_tracer = scope.enableTracing()
+
+    for name, method in methods:
+
+        sim.resetCounters()
+        start = time.perf_counter()
+
+        for i in range(repeat):
+            method()
+
+        elapsed = (time.perf_counter() - start) / repeat
+        counters = dict((key, value / repeat) for key, value in sim.counters.items())
+
+        results[name] = dict(counters, time=elapsed)
+
+    print("\nMethod              Messages  Round trips  Bytes in  Bytes out  Time, s")
+
+    for name, result in results.items():
+        print("{0:<19} {1:>8.0f} {2:>12.0f} {3:>9.0f} {4:>10.0f} {5:>8.3f}".format(
+            name, result['messages'], result['round_trips'], result['bytes_in'], result['bytes_out'], result['time']))
+
+    print("\n"+scpi_tracer.summary())
+
+    scope.disableTracing()
+
+    return results
+
+
+if __name__ == '__main__':
+
+    ipaddress = sys.argv[1] if len(sys.argv) > 1 else 'sim'
+    channel = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    bench = sys.argv[3] if len(sys.argv) > 3 else 'methods'
+
+    if ipaddress == 'sim':
+
+        with simulator() as sim:
+
+            scope = oscillograph(pyvisa.ResourceManager('@py'))
+            session = scope.connect(sim.host, 'SOCKET', sim.port)
+
+            if bench == 'vpp':
+                benchVoltagePP(scope, session, channel)
+            elif bench == 'pipeline':
+                benchPipeline(scope, session, channel)
+            else:
+                benchMethods(sim, scope, session, channel)
+
+    else:
+
+        scope = oscillograph()
+
+        if bench == 'transport':
+            benchTransports(scope, ipaddress, channel)
+        elif bench == 'pipeline':
+            benchPipeline(scope, scope.connect(ipaddress), channel)
+        else:
+            session = scope.connect(ipaddress)
+            benchVoltagePP(scope, session, channel)
@@ -1,617 +1,3665 @@
 #!/usr/bin/env python3
 
-import pyvisa
 import time
 
+import argparse
+import contextlib
+import functools
+import json
+import logging
+import os
+import queue
+import socket
+import sys
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from bisect import bisect_left
+
+log = logging.getLogger('rtb2002')
+
 
 ############################################################
-#  Class for work with Rhode&Schwarz oscilloscope RTB2002
+#  pyvisa module, imported on first use so import of
+#  rtb2002 does not load VISA library and backends
 ############################################################
-class oscillograph(object):
+def _pyvisa():
+
+    import pyvisa
+
+    return pyvisa
+
+
+############################################################
+#  VISA resource string of oscilloscope
+#  - address - IP-address or complete VISA resource string
+#  - transport - 'INSTR'  - VXI-11
+#              - 'SOCKET' - raw SCPI socket (port)
+#              - 'HISLIP' - HiSLIP
+############################################################
+def resourceName(address, transport='INSTR', port=5025):
+
+    if '::' in address:
+        return address
+
+    if transport == 'SOCKET':
+        return 'TCPIP::'+address+'::'+str(port)+'::SOCKET'
+
+    if transport == 'HISLIP':
+        return 'TCPIP::'+address+'::hislip0::INSTR'
+
+    return 'TCPIP::'+address+'::INSTR'
+
+
+
+############################################################
+#  SCPI latency tracer
+#  Records count, bytes, timeouts and log2 latency histogram
+#  per high-level method and SCPI command header
+############################################################
+class tracer(object):
+
+    # Bucket n of histogram counts latencies below 2**n us
+    BUCKETS = 32
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.reset()
+
 
     #####################################################################
-    #  Init function (trying open VISA TCP Socket)
+    # Clear recorded statistics
     #####################################################################
-    def __init__(self):
+    def reset(self):
+
+        with self.lock:
+            self.commands = {}
+            self.methods = {}
+
+
+    #####################################################################
+    # Call function and record its latency
+    #####################################################################
+    def trace(self, method, kind, command, func, *args, **kwargs):
 
-        default_ipaddress = '192.168.1.106'
+        start = time.perf_counter()
+        result = None
+        timeout = False
 
-        self.rm = pyvisa.ResourceManager()
-        self.inst = self.rm.open_resource('TCPIP::'+default_ipaddress+'::INSTR')
-        self.inst.close()
+        try:
+            result = func(*args, **kwargs)
+            return result
+        except Exception as e:
+            timeout = isinstance(e, TimeoutError) or getattr(e, 'abbreviation', '') == 'VI_ERROR_TMO'
+            raise
+        finally:
+            nbytes = len(command) + (len(result) if hasattr(result, '__len__') else 0)
+            self.record(method, kind+' '+self._header(command), nbytes, time.perf_counter() - start, timeout)
 
 
     #####################################################################
-    # Create connection
+    # Headers of SCPI line without arguments
     #####################################################################
-    def connect(self, ipaddress):
+    def _header(self, command):
+
+        return ';'.join(unit.strip().split(' ', 1)[0] for unit in command.split(';'))[:60]
+
+
+    #####################################################################
+    # Record one command
+    #####################################################################
+    def record(self, method, command, nbytes, latency, timeout=False):
+
+        key = (method or '-', command)
+        bucket = min(int(latency * 1e6).bit_length(), self.BUCKETS - 1)
+
+        with self.lock:
+
+            stat = self.commands.get(key)
+
+            if stat is None:
+                stat = self.commands[key] = {'count': 0, 'bytes': 0, 'time': 0.0, 'max': 0.0,
+                                             'timeouts': 0, 'histogram': [0] * self.BUCKETS}
+
+            stat['count'] = stat['count'] + 1
+            stat['bytes'] = stat['bytes'] + nbytes
+            stat['time'] = stat['time'] + latency
+            stat['max'] = max(stat['max'], latency)
+            stat['timeouts'] = stat['timeouts'] + int(timeout)
+            stat['histogram'][bucket] = stat['histogram'][bucket] + 1
+
+
+    #####################################################################
+    # Record call of high-level method
+    #####################################################################
+    def recordMethod(self, method, elapsed):
+
+        with self.lock:
+            stat = self.methods.setdefault(method, {'count': 0, 'time': 0.0})
+            stat['count'] = stat['count'] + 1
+            stat['time'] = stat['time'] + elapsed
+
+
+    #####################################################################
+    # Upper bound of latency percentile from histogram (s)
+    #####################################################################
+    def _percentile(self, histogram, fraction):
+
+        limit = fraction * sum(histogram)
+        total = 0
+
+        for bucket, count in enumerate(histogram):
+            total = total + count
+            if total >= limit:
+                return (1 << bucket) / 1e6
+
+        return (1 << (self.BUCKETS - 1)) / 1e6
+
+
+    #####################################################################
+    # Statistics as list of dictionaries
+    #####################################################################
+    def results(self):
+
+        with self.lock:
+            items = [(key, dict(stat, histogram=list(stat['histogram']))) for key, stat in self.commands.items()]
+            methods = dict((name, dict(stat)) for name, stat in self.methods.items())
+
+        commands = []
+
+        for (method, command), stat in items:
+            stat.update(method=method, command=command,
+                        mean=stat['time'] / stat['count'],
+                        p50=self._percentile(stat['histogram'], 0.5),
+                        p99=self._percentile(stat['histogram'], 0.99))
+            commands.append(stat)
+
+        commands.sort(key=lambda stat: (stat['method'], -stat['time']))
+
+        return {'methods': methods, 'commands': commands}
+
+
+    #####################################################################
+    # Statistics as JSON
+    #####################################################################
+    def toJSON(self):
+
+        return json.dumps(self.results(), indent=2)
+
+
+    #####################################################################
+    # Statistics as text table
+    #####################################################################
+    def summary(self):
+
+        results = self.results()
+
+        lines = ["Method               Calls   Time, s"]
+
+        for name, stat in sorted(results['methods'].items()):
+            lines.append("{0:<20} {1:>5} {2:>9.3f}".format(name, stat['count'], stat['time']))
+
+        lines.append("")
+        lines.append("{0:<20} {1:<40} {2:>6} {3:>9} {4:>9} {5:>9} {6:>9} {7:>9} {8:>4}".format(
+            'Method', 'Command', 'Count', 'Bytes', 'Mean, ms', 'p50, ms', 'p99, ms', 'Max, ms', 'TMO'))
+
+        for stat in results['commands']:
+            lines.append("{0:<20} {1:<40} {2:>6} {3:>9} {4:>9.3f} {5:>9.3f} {6:>9.3f} {7:>9.3f} {8:>4}".format(
+                stat['method'], stat['command'][:40], stat['count'], stat['bytes'], stat['mean'] * 1000,
+                stat['p50'] * 1000, stat['p99'] * 1000, stat['max'] * 1000, stat['timeouts']))
+
+        return "\n".join(lines)
+
+
+
+############################################################
+#  Decorator of high-level oscillograph methods: commands
+#  are grouped by outermost traced method
+############################################################
+def _traced(func):
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+
+        if self.tracer is None or self.trace_method is not None:
+            return func(self, *args, **kwargs)
+
+        self.trace_method = func.__name__
+        start = time.perf_counter()
 
-        # Trying to open TCP connection 
         try:
-            self.rm = pyvisa.ResourceManager()
-            self.inst = self.rm.open_resource('TCPIP::'+ipaddress+'::INSTR')
-            print("INFO: Connected oscilloscope with TCP-IP connection:{0}\n\r".format(ipaddress))
-            return self.inst
-        except: 
-            print("ERROR: Can not open connection with IP-address {0}".format(ipaddress))
+            return func(self, *args, **kwargs)
+        finally:
+            self.trace_method = None
+            self.tracer.recordMethod(func.__name__, time.perf_counter() - start)
+
+    return wrapper
+
+
+
+############################################################
+#  Vertical autoranging over 1-2-5 scale table
+#  Every measurement at current scale is passed to next(),
+#  which returns next scale to try or None when settled:
+#  - valid amplitude - jump to smallest scale which fits it
+#  - clipped result  - bisection between clipped scale and
+#                      smallest scale known to fit
+############################################################
+class autorange(object):
+
+    # Vertical scales in V/div
+    SCALES = (0.001, 0.002, 0.005,
+              0.01, 0.02, 0.05,
+              0.1, 0.2, 0.5,
+              1, 2, 5,
+              10, 20, 50)
+
+    # Part of screen height used by signal
+    HEADROOM = 0.8
+
+    def __init__(self, scale, divisions=10):
+
+        self.index = min(bisect_left(self.SCALES, scale * 0.999), len(self.SCALES) - 1)
+        self.divisions = divisions
+
+        # Range of scales where signal may fit
+        self.low = 0
+        self.high = len(self.SCALES) - 1
+
+        self.steps = 0
+        self.overrange = False
 
 
+    @property
+    def scale(self):
+
+        return self.SCALES[self.index]
+
 
     #####################################################################
-    # Check is device online
-    #####################################################################    
-    def pingDevice(self, session):
-        
-        answer = session.query('*IDN?')
+    # Smallest scale index which fits amplitude (peak-to-peak span in V)
+    #####################################################################
+    def fit(self, amplitude):
+
+        index = bisect_left(self.SCALES, amplitude / (self.divisions * self.HEADROOM))
+
+        return min(max(index, self.low), len(self.SCALES) - 1)
+
+
+    #####################################################################
+    # Pass result measured at current scale
+    # - amplitude - peak-to-peak span of signal in V
+    # - clipped - 1 if result is clipped or invalid
+    # Returns next scale or None if settled
+    #####################################################################
+    def next(self, amplitude, clipped):
+
+        self.steps = self.steps + 1
+
+        if clipped:
+
+            self.low = self.index + 1
+
+            if self.low > self.high:
+                self.overrange = True
+                return None
+
+            target = (self.low + self.high) // 2
 
-        if 'Rohde&Schwarz,RTB2002' in answer:
-            print("INFO: Oscilloscope connected ")
-            print("Версия ПО: {0}".format(answer))
-            return 0
         else:
-            print("ERROR: Oscilloscope not found!\n\r")
-            return 1
+
+            target = self.fit(amplitude)
+
+            if target <= self.index:
+                self.high = self.index
+
+            if target == self.index:
+                return None
+
+        # Guard against oscillation on noisy signals
+        if self.steps > len(self.SCALES):
+            return None
+
+        self.index = target
+
+        return self.scale
+
+
+
+############################################################
+#  Fixed-size ring buffer of timestamped readings
+#  Columns: time (s since epoch), value, state (status bits)
+#  - capacity - number of last readings kept in memory
+#  - spill - file prefix, every column is appended to raw
+#            file '<spill>.<column>' (little endian), so
+#            complete log is kept on disk
+#  - spill_block - number of readings written at once
+############################################################
+class ringBuffer(object):
+
+    DTYPE = np.dtype([('time', '<f8'), ('value', '<f8'), ('state', '<u2')])
+
+    def __init__(self, capacity, spill=None, spill_block=4096):
+
+        self.data = np.zeros(capacity, dtype=self.DTYPE)
+        self.capacity = capacity
+
+        # Number of readings appended / written to spill files
+        self.count = 0
+        self.spilled = 0
+
+        self.spill_block = min(spill_block, capacity)
+        self.files = {}
+
+        if spill is not None:
+            for name in self.DTYPE.names:
+                self.files[name] = open(spill+'.'+name, 'ab')
+
+
+    def __enter__(self):
+
+        return self
+
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+
+    def __len__(self):
+
+        return min(self.count, self.capacity)
 
 
     #####################################################################
-    # Reset settings
-    ##################################################################### 
-    def resetDevice(self, session):
+    # Append one reading
+    #####################################################################
+    def append(self, timestamp, value, state):
+
+        self.data[self.count % self.capacity] = (timestamp, value, state)
+        self.count = self.count + 1
+
+        if self.files and self.count - self.spilled >= self.spill_block:
+            self.spill()
+
+
+    #####################################################################
+    # Write readings not yet spilled to column files
+    #####################################################################
+    def spill(self):
+
+        if not self.files or self.count == self.spilled:
+            return
+
+        rows = np.arange(self.spilled, self.count) % self.capacity
+
+        for name, target in self.files.items():
+            self.data[name][rows].tofile(target)
+            target.flush()
+
+        self.spilled = self.count
+
+
+    #####################################################################
+    # Readings in memory, oldest first (structured array copy)
+    #####################################################################
+    def values(self):
+
+        if self.count <= self.capacity:
+            return self.data[:self.count].copy()
+
+        start = self.count % self.capacity
+
+        return np.concatenate((self.data[start:], self.data[:start]))
+
+
+    #####################################################################
+    # Spill remaining readings and close column files
+    #####################################################################
+    def close(self):
+
+        self.spill()
+
+        for target in self.files.values():
+            target.close()
+
+        self.files = {}
+
+
+    #####################################################################
+    # Load complete log from column files as structured array
+    #####################################################################
+    @classmethod
+    def load(cls, spill):
+
+        columns = [np.fromfile(spill+'.'+name, dtype=cls.DTYPE[name]) for name in cls.DTYPE.names]
+
+        data = np.zeros(min(len(column) for column in columns), dtype=cls.DTYPE)
+
+        for name, column in zip(cls.DTYPE.names, columns):
+            data[name] = column[:len(data)]
+
+        return data
+
+
+
+############################################################
+#  Quick measure results of one MEAS:ARES? answer
+#  Values are in V, Hz and s at full precision
+#  overflow - bit mask of fields with overflow sentinel
+#             (9.91e+37 and above - no valid result)
+############################################################
+class quickMeas(object):
+
+    FIELDS = ('vpp', 'vp_upper', 'vp_lower', 'frequency', 'period', 'rms', 'mean', 'rise', 'fall')
+
+    # Values at or above are sentinels of invalid result
+    OVERFLOW = 9.9e+37
+
+    # Record of structured array returned by oscillograph.getQuickMeasBatch()
+    DTYPE = np.dtype([(name, '<f8') for name in FIELDS] + [('overflow', '<u2')])
+
+    __slots__ = FIELDS + ('overflow',)
+
+    def __init__(self, values):
+
+        self.overflow = 0
+
+        for bit, (name, value) in enumerate(zip(self.FIELDS, values)):
+
+            if abs(value) >= self.OVERFLOW:
+                self.overflow = self.overflow | (1 << bit)
+
+            setattr(self, name, value)
+
+
+    #####################################################################
+    # Parse MEAS:ARES? answer
+    #####################################################################
+    @classmethod
+    def parse(cls, answer):
+
+        return cls([float(value) for value in answer.split(',')])
+
+
+    #####################################################################
+    # True if field has valid result (no overflow sentinel)
+    #####################################################################
+    def valid(self, name):
+
+        return not self.overflow & (1 << self.FIELDS.index(name))
+
+
+    def astuple(self):
+
+        return tuple(getattr(self, name) for name in self.FIELDS) + (self.overflow,)
+
+
+    def __repr__(self):
+
+        return 'quickMeas('+', '.join(name+'='+repr(getattr(self, name)) for name in self.__slots__)+')'
+
+
+
+############################################################
+#  Statistics of several waveforms at once
+#  - xtime - time axis in s (1-D array)
+#  - volts - waveforms in V, one per row (2-D array)
+#  - hysteresis - part of half amplitude around middle
+#                 level used for edge detection
+#  Returns dict of 1-D arrays (one value per row):
+#  mean, rms, vpp, vmax, vmin, frequency (NaN if less
+#  than two rising edges found)
+############################################################
+def waveformStats(xtime, volts, hysteresis=0.2):
+
+    volts = np.atleast_2d(volts)
+
+    vmax = volts.max(axis=1)
+    vmin = volts.min(axis=1)
+    mean = volts.mean(axis=1)
+    rms = np.sqrt(np.einsum('ij,ij->i', volts, volts) / volts.shape[1])
+
+    # Schmitt trigger: state +1 above high level, -1 below low level,
+    # samples between levels keep state of last crossing
+    middle = ((vmax + vmin) / 2)[:, None]
+    band = (hysteresis * (vmax - vmin) / 2)[:, None]
+
+    state = np.zeros(volts.shape, np.int8)
+    state[volts > middle + band] = 1
+    state[volts < middle - band] = -1
+
+    last = np.where(state != 0, np.arange(volts.shape[1]), 0)
+    np.maximum.accumulate(last, axis=1, out=last)
+    state = np.take_along_axis(state, last, axis=1)
+
+    rising = (state[:, :-1] == -1) & (state[:, 1:] == 1)
+
+    edges = rising.sum(axis=1)
+    first = rising.argmax(axis=1)
+    final = rising.shape[1] - 1 - rising[:, ::-1].argmax(axis=1)
+
+    step = (xtime[-1] - xtime[0]) / (len(xtime) - 1) if len(xtime) > 1 else np.nan
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frequency = np.where(edges > 1, (edges - 1) / ((final - first) * step), np.nan)
+
+    return {
+        'mean': mean,
+        'rms': rms,
+        'vpp': vmax - vmin,
+        'vmax': vmax,
+        'vmin': vmin,
+        'frequency': frequency,
+    }
+
+
+
+############################################################
+#  Waveform file written by oscillograph.downloadWaveform
+#  Header of WAVEFORM_FILE_HEADER bytes (JSON padded with
+#  spaces) with format, scaling and number of bytes written,
+#  followed by raw samples
+############################################################
+WAVEFORM_FILE_HEADER = 512
+
+def _saveWaveformHeader(file_name, head):
+
+    data = json.dumps(head).encode()
+
+    if len(data) > WAVEFORM_FILE_HEADER:
+        raise ValueError("Waveform file header is too long")
+
+    with open(file_name, 'r+b') as target:
+        target.write(data.ljust(WAVEFORM_FILE_HEADER))
+
+
+############################################################
+#  Open waveform file without loading samples to memory
+#  - mode - 'r' (read only) or 'r+'
+#  Returns tuple (header dict, memmap of raw samples)
+#  Voltage = raw * header['yincrement'] + header['yorigin']
+############################################################
+def openWaveformFile(file_name, mode='r'):
+
+    with open(file_name, 'rb') as source:
+        head = json.loads(source.read(WAVEFORM_FILE_HEADER).decode())
+
+    raw = np.memmap(file_name, dtype=head['dtype'], mode=mode, offset=WAVEFORM_FILE_HEADER, shape=(head['count'],))
+
+    return head, raw
+
+
+
+############################################################
+#  Class for work with Rhode&Schwarz oscilloscope RTB2002
+############################################################
+class oscillograph(object):
+
+    # Adaptive backoff of status polling (s)
+    poll_min_delay = 0.001
+    poll_max_delay = 0.1
+
+    # Wait for service request instead of polling (if VISA backend supports events)
+    use_srq = False
+
+    # Duration of last synchronization wait (s)
+    last_wait = 0.0
+
+    # Number of measurements needed by last autorange settle
+    autorange_steps = 0
+
+    # Confirm cached settings by reading them back before skipping write
+    verify_writes = False
+
+    # Maximum length of one batched SCPI line
+    max_command_length = 1024
+
+    # Errors of last batch: [(command, error)]
+    batch_errors = []
+
+    # Raise RuntimeError at end of failed batch (after errors are assigned)
+    raise_batch_errors = False
+
+    # SCPI latency tracer (None - tracing disabled)
+    tracer = None
+
+    # High-level method which is traced now
+    trace_method = None
+
+    # Directory of saved instrument setups
+    setup_dir = 'setups'
+
+    # Address used when session is opened on first use without address
+    default_address = '192.168.1.106'
+
+    # VISA library of ResourceManager ('' - default, '@py' - pyvisa-py)
+    visa_library = ''
+
+    #####################################################################
+    #  Init function (no I/O, VISA is loaded on first use)
+    #  - rm - ResourceManager shared with other instances (created on
+    #         first use if None)
+    #  - address - IP-address or VISA resource string of session which
+    #              is opened on first use of session property
+    #  - transport, port - see connect
+    #####################################################################
+    def __init__(self, rm=None, address=None, transport='INSTR', port=5025):
+
+        # Known instrument settings per session: {session: {header: value}}
+        self.state_cache = {}
+
+        # Active command batches: {session: {'pending': [...], 'sent': [...], 'settings': set()}}
+        self.batches = {}
+
+        # Answers of *IDN? per session
+        self.identity = {}
+
+        # Found resources per query of listResources
+        self.resources = {}
+
+        self._rm = rm
+        self.inst = None
+
+        self.address = address
+        self.transport = transport
+        self.port = port
+
+
+    #####################################################################
+    # VISA ResourceManager (created on first use)
+    #####################################################################
+    @property
+    def rm(self):
+
+        if self._rm is None:
+            self._rm = _pyvisa().ResourceManager(self.visa_library)
+
+        return self._rm
+
+
+    @rm.setter
+    def rm(self, rm):
+
+        self._rm = rm
+
+
+    #####################################################################
+    # Session of configured address (opened on first use)
+    #####################################################################
+    @property
+    def session(self):
+
+        if self.inst is None:
+
+            address = self.address if self.address is not None else self.default_address
+
+            if self.connect(address, self.transport, self.port) is None:
+                raise ConnectionError("Can not open connection with "+address)
+
+        return self.inst
+
+
+    #####################################################################
+    # Close session
+    #####################################################################
+    def close(self):
+
+        if self.inst is not None:
+            self.flushStateCache(self.inst)
+            self.identity.pop(self.inst, None)
+            self.inst.close()
+            self.inst = None
+
+
+    #####################################################################
+    # List VISA resources (result is cached per query)
+    # - query - VISA resource query, e.g. 'TCPIP?*::INSTR'
+    # - refresh - search again
+    #####################################################################
+    def listResources(self, query='?*::INSTR', refresh=False):
+
+        if refresh or query not in self.resources:
+            self.resources[query] = self.rm.list_resources(query)
+
+        return self.resources[query]
+
+
+    #####################################################################
+    # Create connection
+    # - ipaddress - IP-address or VISA resource string
+    # - transport - 'INSTR' (VXI-11), 'SOCKET' (raw socket on port) or
+    #               'HISLIP' (falls back to VXI-11 if not available)
+    # Transport of complete resource string is given by string itself
+    #####################################################################
+    def connect(self, ipaddress, transport='INSTR', port=5025):
+
+        self.flushStateCache()
+
+        inst = None
+
+        if transport == 'HISLIP' and '::' not in ipaddress:
+            try:
+                inst = self.rm.open_resource(resourceName(ipaddress, transport))
+            except Exception as e:
+                log.info("HiSLIP is not available (%s), using VXI-11", e)
+                transport = 'INSTR'
+
+        # Trying to open TCP connection 
+        try:
+            if inst is None:
+                inst = self.rm.open_resource(resourceName(ipaddress, transport, port))
+
+            # Raw socket has no message framing, responses end with LF
+            if inst.resource_name.endswith('::SOCKET'):
+                inst.read_termination = '\n'
+                inst.write_termination = '\n'
+
+                # Query after write would otherwise wait for delayed ACK (~40 ms)
+                self._setNoDelay(inst)
+
+            self.inst = inst
+
+            log.info("Connected oscilloscope with TCP-IP connection: %s", inst.resource_name)
+            return self.inst
+        except: 
+            log.error("Can not open connection with IP-address %s", ipaddress)
+
+
+
+    #####################################################################
+    # Disable Nagle algorithm of raw socket session
+    #####################################################################
+    def _setNoDelay(self, session):
+
+        try:
+            session.set_visa_attribute(_pyvisa().constants.VI_ATTR_TCPIP_NODELAY, True)
+            return
+        except Exception:
+            pass
+
+        # pyvisa-py does not support attribute for sockets, use its socket
+        backend = getattr(session.visalib, 'sessions', {}).get(session.session)
+        interface = getattr(backend, 'interface', None)
+
+        if isinstance(interface, socket.socket):
+            interface.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            log.info("Can not disable Nagle algorithm of %s", session.resource_name)
+
+
+    #####################################################################
+    # Check is device online
+    #####################################################################    
+    @_traced
+    def pingDevice(self, session):
+        
+        answer = self._query(session, '*IDN?')
+
+        self.identity[session] = answer.strip()
+
+        if 'Rohde&Schwarz,RTB2002' in answer:
+            log.info("Oscilloscope connected")
+            log.info("Версия ПО: %s", answer)
+            return 0
+        else:
+            log.error("Oscilloscope not found!")
+            return 1
+
+
+    #####################################################################
+    # Reset settings
+    ##################################################################### 
+    def resetDevice(self, session):
+
+        log.info("Reset oscilloscope settings")
+        self._write(session, '*RST')
+
+        self.flushStateCache(session)
+
+
+    #####################################################################
+    # Get OPC value 
+    #####################################################################
+    def getOPC(self, session):
+
+        log.debug("Getting OPC bit")
+
+        answer = self._query(session, '*OPC?')
+
+        log.debug("OPC bit value: %s", answer)
+
+        return answer
+
+
+    #####################################################################
+    # Clear status
+    #####################################################################
+    def clearStatus(self, session):
+        
+        log.debug("Clear status")
+        self._write(session, '*CLS')
+
+
+    #####################################################################
+    # Write command (buffered if batch of session is active)
+    #####################################################################
+    def _write(self, session, command):
+
+        batch = self.batches.get(session)
+
+        if batch is not None:
+            batch['pending'].append(command.strip())
+        else:
+            self._send(session, command)
+
+
+    #####################################################################
+    # Query (pending batched commands are sent first)
+    #####################################################################
+    def _query(self, session, command):
+
+        self._flushBatch(session)
+
+        return self._ask(session, command)
+
+
+    #####################################################################
+    # Read raw bytes (pending batched commands are sent first)
+    #####################################################################
+    def _readBytes(self, session, count):
+
+        self._flushBatch(session)
+
+        if self.tracer is None:
+            return session.read_bytes(count)
+
+        return self.tracer.trace(self.trace_method, 'read', '', session.read_bytes, count)
+
+
+    #####################################################################
+    # Query binary values (pending batched commands are sent first)
+    #####################################################################
+    def _queryBinaryValues(self, session, command, **kwargs):
+
+        self._flushBatch(session)
+
+        if self.tracer is None:
+            return session.query_binary_values(command, **kwargs)
+
+        return self.tracer.trace(self.trace_method, 'query', command, session.query_binary_values, command, **kwargs)
+
+
+    #####################################################################
+    # Write binary block (pending batched commands are sent first)
+    #####################################################################
+    def _writeBinaryValues(self, session, command, data):
+
+        self._flushBatch(session)
+
+        if self.tracer is None:
+            return session.write_binary_values(command, data, datatype='B')
+
+        return self.tracer.trace(self.trace_method, 'write', command, session.write_binary_values, command, data, datatype='B')
+
+
+    #####################################################################
+    # Send command to instrument (traced if tracing is enabled)
+    #####################################################################
+    def _send(self, session, command):
+
+        if self.tracer is None:
+            session.write(command)
+        else:
+            self.tracer.trace(self.trace_method, 'write', command, session.write, command)
+
+
+    #####################################################################
+    # Query instrument (traced if tracing is enabled)
+    #####################################################################
+    def _ask(self, session, command):
+
+        if self.tracer is None:
+            return session.query(command)
+
+        return self.tracer.trace(self.trace_method, 'query', command, session.query, command)
+
+
+    #####################################################################
+    # Start recording latency of every SCPI command
+    # - scpi_tracer - tracer to use (may be shared by several instances)
+    # Returns tracer with summary()/toJSON() export
+    #####################################################################
+    def enableTracing(self, scpi_tracer=None):
+
+        self.tracer = scpi_tracer if scpi_tracer is not None else tracer()
+
+        return self.tracer
+
+
+    #####################################################################
+    # Stop recording
+    #####################################################################
+    def disableTracing(self):
+
+        self.tracer = None
+
+
+    #####################################################################
+    # Batch SCPI writes of session into ';:'-joined lines
+    #   with scope.batch(session):
+    #       scope.setVertical(session, 1, 0.1)
+    #       scope.setHorizontal(session, 0.001)
+    # Opc:
+    # - True - wait for completion with single *OPC? at end of batch
+    # Errors are checked once with SYST:ERR? and assigned to commands
+    # (stored in batch_errors). Only settings (_writeSetting) are
+    # replayed to find failed commands, errors of action commands
+    # (*RST, RUNS, ...) are logged without assignment
+    # Failed batch raises RuntimeError if raise_batch_errors is set
+    #####################################################################
+    @contextlib.contextmanager
+    def batch(self, session, opc=True):
+
+        # Nested batch joins outer one
+        if session in self.batches:
+            yield session
+            return
+
+        self.batches[session] = {'pending': [], 'sent': [], 'settings': set()}
+
+        try:
+            yield session
+        except BaseException:
+            # Cached settings of discarded commands are not valid
+            self.batches.pop(session, None)
+            self.flushStateCache(session)
+            raise
+
+        self._endBatch(session, opc)
+
+
+    #####################################################################
+    # Join commands into lines not longer than max_command_length
+    #####################################################################
+    def _joinCommands(self, commands):
+
+        lines = []
+        line = ''
+
+        for command in commands:
+
+            # Common commands (*XXX) must not follow root prefix ':'
+            separator = ';' if command.startswith('*') else ';:'
+
+            if not line:
+                line = command
+            elif len(line) + len(separator) + len(command) > self.max_command_length:
+                lines.append(line)
+                line = command
+            else:
+                line = line + separator + command
+
+        if line:
+            lines.append(line)
+
+        return lines
+
+
+    #####################################################################
+    # Send pending commands of active batch
+    #####################################################################
+    def _flushBatch(self, session):
+
+        batch = self.batches.get(session)
+
+        if not batch or not batch['pending']:
+            return
+
+        for line in self._joinCommands(batch['pending']):
+            self._send(session, line)
+
+        batch['sent'].extend(batch['pending'])
+        batch['pending'] = []
+
+
+    #####################################################################
+    # Send rest of batch with *OPC? and error check in one query
+    #####################################################################
+    def _endBatch(self, session, opc):
+
+        batch = self.batches.pop(session)
+
+        lines = self._joinCommands(batch['pending'])
+        commands = batch['sent'] + batch['pending']
+
+        tail = '*OPC?;:SYST:ERR?' if opc else ':SYST:ERR?'
+
+        if lines and len(lines[-1]) + len(tail) + 1 <= self.max_command_length:
+            tail = lines.pop() + ';' + tail
+
+        for line in lines:
+            self._send(session, line)
+
+        error = self._ask(session, tail).strip()
+
+        # Error message may contain ';', split only *OPC? answer off
+        if opc:
+            error = error.partition(';')[2].strip()
+
+        self.batch_errors = []
+
+        if not error.startswith('0'):
+
+            message = self._reportBatchErrors(session, error, [command for command in commands if command in batch['settings']])
+
+            if self.raise_batch_errors:
+                raise RuntimeError("Batch failed: "+message)
+
+
+    #####################################################################
+    # Find failed commands of batch by replaying them one by one
+    # - commands - settings of batch (safe to send again)
+    # Returns errors of batch joined into one message
+    #####################################################################
+    def _reportBatchErrors(self, session, error, commands):
+
+        errors = [error]
+
+        while not error.startswith('0'):
+            error = self._ask(session, 'SYST:ERR?').strip()
+            errors.append(error)
+
+        message = "; ".join(errors[:-1])
+
+        log.error("Batch failed: %s", message)
+
+        self.flushStateCache(session)
+
+        for command in commands:
+
+            self._send(session, command)
+            error = self._ask(session, 'SYST:ERR?').strip()
+
+            if not error.startswith('0'):
+                log.error("Command '%s' failed: %s", command, error)
+                self.batch_errors.append((command, error))
+
+            while not error.startswith('0'):
+                error = self._ask(session, 'SYST:ERR?').strip()
+
+        return message
+
+
+    #####################################################################
+    # Poll query until answer satisfies condition
+    # Delay between queries grows from poll_min_delay to poll_max_delay
+    # Returns wait time in s (also stored in last_wait)
+    #####################################################################
+    def _pollUntil(self, session, query, condition, timeout):
+
+        start = time.perf_counter()
+        delay = self.poll_min_delay
+
+        while not condition(self._query(session, query)):
+
+            if time.perf_counter() - start > timeout:
+                raise TimeoutError("No response to '{0}' within {1} s".format(query, timeout))
+
+            time.sleep(delay)
+            delay = min(delay * 2, self.poll_max_delay)
+
+        self.last_wait = time.perf_counter() - start
+
+        return self.last_wait
+
+
+    #####################################################################
+    # Wait until all pending operations are complete
+    # - command - optional overlapped command (e.g. 'RUNS') to start
+    #             before waiting
+    # - timeout - maximum wait time in s
+    # Sets *OPC and polls operation complete bit of *ESR? or waits for
+    # service request when use_srq is enabled
+    # Returns wait time in s
+    #####################################################################
+    def waitOperation(self, session, command=None, timeout=30):
+
+        prefix = command+';' if command else ''
+
+        if self.use_srq:
+            return self._waitServiceRequest(session, prefix, timeout)
+
+        # Reading *ESR? clears previous events before *OPC is set
+        self._query(session, prefix+'*ESR?;*OPC')
+
+        wait = self._pollUntil(session, '*ESR?', lambda answer: int(answer) & 0x1, timeout)
+
+        log.debug("Operation complete in %.1f ms", wait * 1000)
+
+        return wait
+
+
+    #####################################################################
+    # Wait for operation complete using service request event
+    #####################################################################
+    def _waitServiceRequest(self, session, prefix, timeout):
+
+        start = time.perf_counter()
+
+        self.clearStatus(session)
+
+        # Operation complete -> ESB bit of status byte -> service request
+        self._write(session, '*ESE 1;*SRE 32;'+prefix+'*OPC')
+        self._flushBatch(session)
+
+        try:
+            session.wait_for_srq(int(timeout * 1000))
+        except Exception as e:
+
+            # Timeouts and I/O errors are real failures
+            if not self._srqUnsupported(e):
+                raise
+
+            # Command is already started, only wait for its *OPC
+            log.info("Service request not supported (%s), using status polling", e)
+            self.use_srq = False
+
+            self._pollUntil(session, '*ESR?', lambda answer: int(answer) & 0x1, max(timeout - (time.perf_counter() - start), 0))
+
+        else:
+            self._query(session, '*ESR?')
+
+        self.last_wait = time.perf_counter() - start
+
+        log.debug("Operation complete (SRQ) in %.1f ms", self.last_wait * 1000)
+
+        return self.last_wait
+
+
+    #####################################################################
+    # Check if exception means that session has no SRQ events
+    #####################################################################
+    def _srqUnsupported(self, error):
+
+        if isinstance(error, (AttributeError, NotImplementedError)):
+            return True
+
+        return getattr(error, 'abbreviation', '') in ('VI_ERROR_NSUP_OPER', 'VI_ERROR_NSUP_EVENT', 'VI_ERROR_INV_EVENT', 'VI_ERROR_NSUP_MECH')
+
+
+    #####################################################################
+    # Start single acquisition and wait until it is complete
+    # Returns wait time in s
+    #####################################################################
+    def acquireSingle(self, session, timeout=30):
+
+        return self.waitOperation(session, 'RUNS', timeout)
+
+
+    #####################################################################
+    # Forget cached settings of session (or of all sessions)
+    # Has to be called after settings were changed outside this class
+    #####################################################################
+    def flushStateCache(self, session=None):
+
+        if session is None:
+            self.state_cache.clear()
+        else:
+            self.state_cache.pop(session, None)
+
+
+    #####################################################################
+    # Write setting only if it differs from cached value
+    # - header - SCPI header of setting (e.g. 'CHAN1:SCAL')
+    # - value - new value
+    # - command - command to send if it is not '<header> <value>'
+    #             (such settings can not be verified by readback)
+    # Returns True if command was sent
+    #####################################################################
+    def _writeSetting(self, session, header, value, command=None):
+
+        cache = self.state_cache.setdefault(session, {})
+        value = str(value)
+
+        if cache.get(header) == value:
+
+            if not self.verify_writes:
+                return False
+
+            if command is None and self._readbackMatches(session, header, value):
+                return False
+
+        command = command if command is not None else header+' '+value
+
+        self._write(session, command)
+        cache[header] = value
+
+        batch = self.batches.get(session)
+
+        if batch is not None:
+            batch['settings'].add(command)
+
+        return True
+
+
+    #####################################################################
+    # Compare setting of instrument with expected value
+    #####################################################################
+    def _readbackMatches(self, session, header, value):
+
+        answer = self._query(session, header+'?').strip().upper()
+        value = value.upper()
+
+        try:
+            return abs(float(answer) - float(value)) <= 1e-9 * max(abs(float(value)), 1e-12)
+        except ValueError:
+            pass
+
+        answer = {'1': 'ON', '0': 'OFF'}.get(answer, answer)
+
+        # Instrument returns short or long form of mnemonic
+        return answer.startswith(value) or value.startswith(answer)
+
+
+    ########################################################################################
+    #                                                                                      #
+    #               Functions to save and restore instrument setups                        #
+    #                                                                                      #
+    ########################################################################################
+
+    #####################################################################
+    # Get *IDN? answer (cached per session, see pingDevice)
+    #####################################################################
+    def getIdentity(self, session):
+
+        if session not in self.identity:
+            self.identity[session] = self._query(session, '*IDN?').strip()
+
+        return self.identity[session]
+
+
+    #####################################################################
+    # File of named setup in directory of instrument model and firmware
+    #####################################################################
+    def _setupPath(self, session, name):
+
+        fields = self.getIdentity(session).split(',')
+        model = fields[1] if len(fields) > 1 else fields[0]
+        firmware = fields[3] if len(fields) > 3 else 'unknown'
+
+        directory = ''.join(c if c.isalnum() or c in '.-' else '_' for c in model+'_'+firmware)
+
+        return os.path.join(self.setup_dir, directory, name+'.set')
+
+
+    #####################################################################
+    # Save complete instrument setup (SYST:SET?) to named setup file
+    # Returns path of file
+    #####################################################################
+    @_traced
+    def saveSetup(self, session, name):
+
+        path = self._setupPath(session, name)
+
+        data = self._queryBinaryValues(session, 'SYST:SET?', datatype='B', container=bytes)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path+'.tmp', 'wb') as target:
+            target.write(data)
+
+        os.replace(path+'.tmp', path)
+
+        log.info("Saved setup %s (%d bytes)", path, len(data))
+
+        return path
+
+
+    #####################################################################
+    # Restore named setup with one transfer (SYST:SET)
+    # Returns False if setup was not saved for this instrument
+    #####################################################################
+    @_traced
+    def restoreSetup(self, session, name):
+
+        path = self._setupPath(session, name)
+
+        if not os.path.exists(path):
+            return False
+
+        with open(path, 'rb') as source:
+            data = source.read()
+
+        self._writeBinaryValues(session, 'SYST:SET ', data)
+
+        # All settings may be changed
+        self.flushStateCache(session)
+        self.getOPC(session)
+
+        log.info("Restored setup %s", path)
+
+        return True
+
+
+    #####################################################################
+    # Restore named setup or create it
+    # - configure - function which makes setup if it is not saved yet
+    #####################################################################
+    def useSetup(self, session, name, configure):
+
+        if self.restoreSetup(session, name):
+            return
+
+        configure()
+
+        self.getOPC(session)
+        self.saveSetup(session, name)
+
+
+    #####################################################################
+    # Names of setups saved for instrument
+    #####################################################################
+    def listSetups(self, session):
+
+        directory = os.path.dirname(self._setupPath(session, 'setup'))
+
+        if not os.path.isdir(directory):
+            return []
+
+        return sorted(file_name[:-4] for file_name in os.listdir(directory) if file_name.endswith('.set'))
+
+
+    #####################################################################
+    # Save setup to internal memory slot of instrument (*SAV)
+    #####################################################################
+    def saveSetupSlot(self, session, slot):
+
+        self._write(session, '*SAV '+str(slot))
+
+
+    #####################################################################
+    # Recall setup from internal memory slot of instrument (*RCL)
+    #####################################################################
+    def recallSetupSlot(self, session, slot):
+
+        self._write(session, '*RCL '+str(slot))
+
+        self.flushStateCache(session)
+
+
+    #####################################################################
+    # Get screenshot from device
+    #####################################################################
+    @_traced
+    def getScreenshot(self, session, screen_name):
+
+        try:
+
+            self._write(session, "MMEM:CDIR '/USB_FRONT/'")
+
+            self._write(session, "MMEM:DEL 'SCREEN.png'")
+            
+            self.getOPC(session)
+            self.clearStatus(session)
+
+            self._write(session, "HCOP:LANG PNG;:MMEM:NAME 'SCREEN'")
+
+            self._write(session, "HCOP:IMM")
+
+            self.getOPC(session)
+
+            img = self._readScreenFile(session)
+
+            target = open(screen_name, 'wb')
+            target.write(img)
+
+            log.info("Getting screenshot from device: %s", screen_name)
+            target.close()
+
+        except:
+            log.exception("Failed getting screenshot from device")
+
+
+
+    #####################################################################
+    # Read screenshot file from oscilloscope memory
+    #####################################################################
+    def _readScreenFile(self, session, file_name='SCREEN.png'):
+
+        return self._queryBinaryValues(session, "MMEM:DATA? '"+file_name+"'", datatype='B', container=bytearray)
+
+
+    #####################################################################
+    # Get screenshot directly from display buffer (HCOP:DATA?)
+    # Image is streamed to file in chunks, no USB stick is needed
+    # Returns size of image in bytes
+    #####################################################################
+    @_traced
+    def getScreenshotDirect(self, session, screen_name, chunk_size=64*1024):
+
+        self._writeSetting(session, 'HCOP:LANG', 'PNG')
+        self._write(session, 'HCOP:DATA?')
+
+        nbytes = self._readBlockHeader(session)
+
+        with open(screen_name, 'wb') as target:
+            for chunk in self._readBlockChunks(session, nbytes, chunk_size):
+                target.write(chunk)
+
+        log.info("Getting screenshot from device: %s (%d bytes)", screen_name, nbytes)
+
+        return nbytes
+
+
+    #####################################################################
+    # Capture series of screenshots from display buffer
+    # - screen_pattern - file name with frame number, e.g. 'screen_{0:04d}.png'
+    # - frames - number of screenshots
+    # - rate - target rate in frames per second (0 or None - as fast
+    #          as possible)
+    # Files are written by background thread while next frame is read
+    # Returns list of file names
+    #####################################################################
+    @_traced
+    def captureScreenshots(self, session, screen_pattern, frames, rate=1.0):
+
+        images = queue.Queue(maxsize=8)
+        errors = []
+
+        def writer():
+            while True:
+                item = images.get()
+                if item is None:
+                    break
+                try:
+                    with open(item[0], 'wb') as target:
+                        target.write(item[1])
+                except Exception as e:
+                    errors.append(e)
+
+        thread = threading.Thread(target=writer, daemon=True)
+        thread.start()
+
+        self._writeSetting(session, 'HCOP:LANG', 'PNG')
+
+        names = []
+        start = time.perf_counter()
+
+        try:
+            for frame in range(frames):
+
+                if rate:
+                    delay = start + frame / rate - time.perf_counter()
+
+                    if delay > 0:
+                        time.sleep(delay)
+
+                self._write(session, 'HCOP:DATA?')
+
+                name = screen_pattern.format(frame)
+                images.put((name, self._readBlock(session)))
+                names.append(name)
+
+        finally:
+            images.put(None)
+            thread.join()
+
+        elapsed = time.perf_counter() - start
+
+        log.info("Captured %d screenshots in %.2f s (%.2f frames/s)", len(names), elapsed, len(names) / elapsed if elapsed else 0.0)
+
+        if errors:
+            raise errors[0]
+
+        return names
+
+
+
+    ########################################################################################
+    #                                                                                      #
+    #               Functions for measurments setup                                        #
+    #                                                                                      #
+    ########################################################################################
+
+    #####################################################################
+    #   Set vertical scale
+    #   Channel:
+    #   - from 1 to 4
+    #   Value:
+    #   - value in V
+    #####################################################################
+    def setVertical(self, session, channel, value):
+        
+        if self._writeSetting(session, 'CHAN'+str(channel)+':SCAL', value):
+            log.info("Set vertical scale to channel: %s value: %s", channel, value)
+
+
+    #####################################################################
+    # Set bandwidth 
+    #  'B20' -  20MHz band
+    #  'FULL' - full bandwidth
+    #####################################################################
+    def setBandwidth(self, session, channel, bandwidth):
+        
+        if bandwidth == '20':
+            bandwidth = 'B20'
+        else:
+            bandwidth = 'FULL'
+
+        if self._writeSetting(session, 'CHAN'+str(channel)+':BAND', bandwidth):
+            log.info("Set bandwidth to channel: %s value: %s", channel, bandwidth)
+
+    
+    #####################################################################
+    # Set time scale
+    # Value:
+    # - seconds
+    #####################################################################
+    def setHorizontal(self, session, value):
+
+        self._writeSetting(session, 'TIM:SCAL', value)
+
+
+    #####################################################################
+    # Settle vertical scale of channel with autorange engine
+    # Scale:
+    # - starting vertical scale in V
+    # Measure:
+    # - function returning (peak-to-peak span in V, clipped) at current
+    #   scale
+    # Returns autorange object (settled scale, number of steps)
+    #####################################################################
+    def autorangeVertical(self, session, channel, scale, measure):
+
+        ranger = autorange(scale)
+
+        self.setVertical(session, channel, ranger.scale)
+
+        while True:
+
+            amplitude, clipped = measure()
+
+            scale = ranger.next(amplitude, clipped)
+
+            if scale is None:
+                break
+
+            self.setVertical(session, channel, scale)
+
+        self.autorange_steps = ranger.steps
+
+        if ranger.overrange:
+            log.error("Signal is clipped at maximum vertical scale %s", ranger.scale)
+        else:
+            log.info("Vertical scale settled at %s in %d steps", ranger.scale, ranger.steps)
+
+        return ranger
+
+
+
+    ########################################################################################
+    #                                                                                      #
+    #               Functions for work with oscilloscope channels                          #
+    #                                                                                      #
+    ########################################################################################
+
+    #####################################################################
+    # Set channel state
+    # - channel - number of channel
+    # - state - 1 - on
+    #         - 0 - off
+    #####################################################################
+    def setChannelState(self, session, channel, state):
+
+        if(state == 1):
+            state = 'ON'
+        else:
+            state = 'OFF'
+
+        self._writeSetting(session, 'CHAN'+str(channel)+':STAT', state)
+
+
+    #####################################################################
+    # Set coupling mode on channel on oscilloscope
+    #####################################################################
+    def setChannelCoupling(self, session, channel, coupling):
+
+        if coupling == 'DC':
+            coupling = 'DCL'
+
+        elif coupling == 'AC':
+            coupling = 'ACL'
+
+        else:
+            coupling = 'GND'
+
+        self._writeSetting(session, 'CHAN'+str(channel)+':COUP', coupling)
+
+
+    ########################################################################################
+    #                                                                                      #
+    #               Functions to work with trigger options                                 #
+    #                                                                                      #
+    ########################################################################################
+
+    #####################################################################
+    # Set trigger source 
+    #####################################################################
+    def setTriggerSource(self, session, channel):
+
+        if channel == 1:
+            channel = 'CH1'
+
+        elif channel == 2:
+            channel = 'CH2'
+
+        elif channel == 3:
+            channel = 'CH3'
+
+        elif channel == 4:
+            channel = 'CH4'
+
+        self._writeSetting(session, 'TRIG:A:SOUR', channel)
+
+
+    #####################################################################
+    # Function to find trigger level
+    #####################################################################
+    def setTriggerFindLevel(self, session):
+
+        self._write(session, 'TRIG:A:FIND')
+
+
+
+    ########################################################################################
+    #                                                                                      #
+    #               Functions to work with integrated digial voltmeter                     #
+    #                                                                                      #
+    ########################################################################################
+
+    #####################################################################
+    # On/off digital voltmeter
+    #####################################################################
+    def setVoltmeterState(self, session, state):
+        
+        if(state == 1):
+            state = 'ON'
+        else:
+            state = 'OFF'
+
+        self._writeSetting(session, 'DVM:ENAB', state)
+
+
+    #####################################################################
+    # Set parameters of digital voltmeter
+    # Channel:
+    # - from 1 to 4
+    # Voltage_type:
+    # - DC
+    # - ACDCrms
+    # - ACRMs
+    # - OFF
+    #####################################################################
+    def setVoltmeterParam(self, session, channel, voltage_type):
+
+        if(channel == 1):
+            channel = 'CH1'
+
+        elif(channel == 2):
+            channel = 'CH2'
+
+        elif(channel == 3):
+            channel = 'CH3'
+
+        elif(channel == 4):
+            channel = 'CH4'
+
+        self._writeSetting(session, 'DVM:SOUR', channel)
+
+
+        if(voltage_type == 'ACDCrms'):
+            voltage_type = 'ACDC'
+
+        elif(voltage_type == 'ACRMs'):
+            voltage_type = 'ACRM'
+
+        self._writeSetting(session, 'DVM:TYPE', voltage_type)
+
+
+    #####################################################################
+    # Function returns voltmeter status
+    #####################################################################
+    def getVoltmeterStatus(self, session):
+
+        status = self._query(session, 'DVM:RES:STAT?')
+        status_arr = status.split(',')
+
+        return status_arr[1].replace('\\n\'','')
+
+
+    #####################################################################
+    # Function used for print voltmeter status
+    #####################################################################
+    def printVoltmeterStatus(self, session):
+
+        state_bin = int(self.getVoltmeterStatus(session))
+
+        if((state_bin & 0x1 ) == 1):
+            print ("Result is valid")
+        elif((state_bin & 0x1 ) == 0):
+            print ("Result is invalid")
+
+
+        if((state_bin & 0x2 ) == 2):
+            print ("No result avaliable")
+        elif((state_bin & 0x2 ) == 0):
+            print ("Result is avaliable")
+
+
+        if((state_bin & 0x4 ) == 4):
+            print ("No period found")       
+        elif((state_bin & 0x4 ) == 0):
+            print ("Period found")          
+
+
+        if((state_bin & 0x8 ) == 8):
+            print ("Clipping occurs")      
+        elif((state_bin & 0x8 ) == 0):
+            print ("Clipping no occurs")    
+        
+
+    #####################################################################
+    # Get clipping status of digital voltmeter
+    #####################################################################    
+    def getVoltmeterStatusClipping(self, session):
+
+        state_bin = int(self.getVoltmeterStatus(session))
+
+        if((state_bin & 0x8 ) == 8):
+            return 1    
+        elif((state_bin & 0x8 ) == 0):
+            return 0
+
+
+    #####################################################################
+    # Check answer of DVM:RES:STAT? for available result or clipping
+    #####################################################################
+    def _voltmeterReady(self, answer):
+
+        state_bin = int(answer.split(',')[-1])
+
+        return (state_bin & 0x2) == 0 or (state_bin & 0x8) == 8
+
+
+    #####################################################################
+    # Wait until voltmeter result is available (or clipping is detected)
+    # Returns wait time in s
+    #####################################################################
+    def waitVoltmeterResult(self, session, timeout=10):
+
+        wait = self._pollUntil(session, 'DVM:RES:STAT?', self._voltmeterReady, timeout)
+
+        log.debug("Voltmeter result ready in %.1f ms", wait * 1000)
+
+        return wait
+
+
+    #####################################################################
+    # Get voltmeter measured value
+    #####################################################################
+    @_traced
+    def getVoltmeterValue(self, session, channel, scale=0.5):
+
+        self.autorangeVertical(session, channel, scale, lambda: self._measureVoltmeter(session))
+
+        # Last probe acquired at settled scale, scope is stopped
+        voltage, state_bin = self.readVoltmeter(session)
+
+        self.setAcqState(session, "RUN")
+
+        voltage = round(voltage, 3)
+
+        return voltage
+
+
+    #####################################################################
+    # Read voltmeter value and status in one query
+    # Returns tuple (value, status bits)
+    #####################################################################
+    def readVoltmeter(self, session):
+
+        answer = self._query(session, 'DVM:RES?;:DVM:RES:STAT?').split(';')
+
+        voltage = float(answer[0])
+        state_bin = int(answer[1].rsplit(',', 1)[-1])
+
+        return voltage, state_bin
+
+
+    #####################################################################
+    # Autorange probe: voltmeter result at current vertical scale
+    # New acquisition is needed, in continuous mode result and clipping
+    # bit may still belong to previous scale
+    #####################################################################
+    def _measureVoltmeter(self, session):
+
+        self.acquireSingle(session)
+        self.waitVoltmeterResult(session)
+
+        return self._voltmeterSpan(*self.readVoltmeter(session))
+
+
+    #####################################################################
+    # Span of voltmeter result for autorange (None if clipped)
+    #####################################################################
+    def _voltmeterSpan(self, voltage, state_bin):
+
+        if (state_bin & 0x8) == 8:
+            return None, 1
+
+        # Channel offset is 0, so screen has to fit +/- value
+        return 2 * abs(voltage), 0
+        
+
+    #####################################################################
+    # Print measured value
+    #####################################################################
+    def printVoltmeterValue(self, session, channel):
+
+        print(self.getVoltmeterValue(session, channel))
+
+
+    #####################################################################
+    # Stream voltmeter readings (generator)
+    # Voltmeter is configured once, then every reading costs one query
+    # - channel, voltage_type - see setVoltmeterParam
+    # - interval - minimal period of readings in s (0 - as fast as possible)
+    # - count, duration - stop after number of readings / time in s
+    #                     (None - endless)
+    # - ring - ringBuffer which receives every reading
+    # Yields tuples (time since epoch, value, status bits of DVM:RES:STAT?)
+    # Vertical scale is not changed, check status bits for clipping (0x8)
+    #####################################################################
+    def streamVoltmeter(self, session, channel, voltage_type='DC', interval=0.0, count=None, duration=None, ring=None):
+
+        self.setVoltmeterState(session, 1)
+        self.setVoltmeterParam(session, channel, voltage_type)
+        self.waitOperation(session)
+
+        readings = 0
+        start = time.perf_counter()
+        next_time = start
+
+        while count is None or readings < count:
+
+            now = time.perf_counter()
+
+            if duration is not None and now - start >= duration:
+                break
+
+            if interval:
+                if next_time > now:
+                    time.sleep(next_time - now)
+                next_time = next_time + interval
+
+            voltage, state_bin = self.readVoltmeter(session)
+            timestamp = time.time()
+
+            if ring is not None:
+                ring.append(timestamp, voltage, state_bin)
+
+            readings = readings + 1
+
+            yield timestamp, voltage, state_bin
+
+        elapsed = time.perf_counter() - start
+
+        log.info("Voltmeter stream: %d readings in %.1f s (%.1f readings/s)", readings, elapsed, readings / elapsed if elapsed else 0.0)
+
+
+    #####################################################################
+    # Log voltmeter readings into ring buffer
+    # - capacity - number of last readings kept in memory
+    # - spill - file prefix of append-only column files (see ringBuffer)
+    # Other parameters - see streamVoltmeter
+    # Returns ringBuffer (column files are closed)
+    #####################################################################
+    @_traced
+    def logVoltmeter(self, session, channel, capacity, voltage_type='DC', spill=None, interval=0.0, count=None, duration=None):
+
+        with ringBuffer(capacity, spill) as ring:
+            for reading in self.streamVoltmeter(session, channel, voltage_type, interval, count, duration, ring):
+                pass
+
+        return ring
+
+
+
+    ########################################################################################
+    #                                                                                      #
+    #               Fuction to work with measure sequence                                  #
+    #                                                                                      #
+    ########################################################################################
+
+    #####################################################################
+    # Set single shot or continous mode measure
+    #####################################################################
+    def setAcqState(self, session, state):
+
+        if(state == "RUN"):
+            nstate = 'RUNC'
+        elif(state == "SINGLE"):
+            nstate = 'RUNS'
+
+        self._write(session, nstate)
+
+
+    ########################################################################################
+    #                                                                                      #
+    #               Fuction to work with quick measure sequence                            #
+    #                                                                                      #
+    ########################################################################################
+
+    #####################################################################
+    # On/off quick measure mode 
+    #####################################################################
+    def setQuickMeasState(self, session, state):
+
+        if(state == 1):
+            command = 'MEAS:AON'
+        else:
+            command = 'MEAS:AOFF'
+
+        self._writeSetting(session, 'MEAS:A', state, command)
+
+    #####################################################################
+    # Get quick measure Vpp value
+    #####################################################################
+    def getQuickMeasVpp(self, session):
+
+        result = self._query(session, 'MEAS:ARES?')
+        result_arr = result.split(',')
+        result_alg = float(result_arr[0])
+
+        return round(result_alg*1000, 1)
+
+    
+    #####################################################################
+    # Get VULpe value
+    #####################################################################
+    def getQuickMeasVULpe(self, session):
+
+        result_ul = []
+
+        result = self._query(session, 'MEAS:ARES?')
+
+        result_arr = result.split(',')
+        result_upe = float(result_arr[1])
+        result_lpe = float(result_arr[2])
+
+        result_ul.append(round(result_upe, 1))
+        result_ul.append(round(result_lpe, 1))
+
+        return result_ul
+
+
+    #####################################################################
+    # Get all quick measure results with one query
+    # Returns quickMeas record (full precision, overflow flags)
+    #####################################################################
+    def getQuickMeasAll(self, session):
+
+        return quickMeas.parse(self._query(session, 'MEAS:ARES?'))
+
+
+    #####################################################################
+    # Get quick measure results of several single acquisitions
+    # - count - number of acquisitions
+    # Returns NumPy structured array with quickMeas.DTYPE records
+    #####################################################################
+    @_traced
+    def getQuickMeasBatch(self, session, count, timeout=30):
+
+        results = np.zeros(count, dtype=quickMeas.DTYPE)
+
+        for i in range(count):
+
+            self.acquireSingle(session, timeout)
+
+            results[i] = self.getQuickMeasAll(session).astuple()
+
+        return results
+
+
+    ########################################################################################
+    #                                                                                      #
+    #               Functions to work with waveform data                                   #
+    #                                                                                      #
+    ########################################################################################
+
+    # Binary formats of CHAN:DATA? and matching NumPy types (little endian)
+    WAVEFORM_FORMATS = {
+        'UINT,8':  'u1',
+        'UINT,16': '<u2',
+        'REAL,32': '<f4',
+    }
+
+    #####################################################################
+    # Read header of IEEE-488.2 definite length block ("#<n><length>")
+    # Returns number of data bytes which follow the header
+    #####################################################################
+    def _readBlockHeader(self, session):
+
+        head = self._readBytes(session, 2)
+
+        # Skip whitespace which may precede the block
+        while head[0:1] != b'#' and head[0:1].isspace():
+            head = head[1:2] + self._readBytes(session, 1)
+
+        if head[0:1] != b'#' or not head[1:2].isdigit() or head[1:2] == b'0':
+            raise ValueError("Invalid binary block header: {0!r}".format(head))
+
+        return int(self._readBytes(session, int(head[1:2])))
+
+
+    #####################################################################
+    # Read IEEE-488.2 binary block directly into preallocated buffer
+    # - out - writable C-contiguous buffer (NumPy array, bytearray)
+    # Returns number of received bytes
+    #####################################################################
+    def _readBlockInto(self, session, out, chunk_size=1024*1024):
+
+        nbytes = self._readBlockHeader(session)
+
+        view = memoryview(out).cast('B')
+
+        if nbytes > len(view):
+            raise ValueError("Binary block of {0} bytes does not fit buffer of {1} bytes".format(nbytes, len(view)))
+
+        pos = 0
+
+        for chunk in self._readBlockChunks(session, nbytes, chunk_size):
+            view[pos:pos+len(chunk)] = chunk
+            pos = pos + len(chunk)
+
+        return nbytes
+
+
+    #####################################################################
+    # Read data of binary block in chunks (after header was read)
+    # Yields chunks of at most chunk_size bytes
+    #####################################################################
+    def _readBlockChunks(self, session, nbytes, chunk_size=1024*1024):
+
+        pos = 0
+
+        while pos < nbytes:
+            chunk = self._readBytes(session, min(chunk_size, nbytes - pos))
+            pos = pos + len(chunk)
+            yield chunk
+
+        # Block is terminated by LF
+        self._readBytes(session, 1)
+
+
+    #####################################################################
+    # Read complete binary block into new bytearray
+    #####################################################################
+    def _readBlock(self, session, chunk_size=1024*1024):
+
+        nbytes = self._readBlockHeader(session)
+        data = bytearray(nbytes)
+
+        pos = 0
+
+        for chunk in self._readBlockChunks(session, nbytes, chunk_size):
+            data[pos:pos+len(chunk)] = chunk
+            pos = pos + len(chunk)
+
+        return data
+
+
+    #####################################################################
+    # Get waveform header and scaling of channel
+    # Returns dictionary:
+    # - xstart, xstop - time of first and last sample in s
+    # - points - record length
+    # - values - values per sample (2 for envelope/peak detect)
+    # - yorigin, yincrement - conversion of integer samples to V
+    #####################################################################
+    def getWaveformHeader(self, session, channel, data_format='UINT,8'):
+
+        chan = 'CHAN'+str(channel)+':DATA:'
+
+        if data_format == 'REAL,32':
+            answer = self._query(session, chan+'HEAD?')
+            scale = ['0', '1']
+        else:
+            parts = self._query(session, chan+'HEAD?;:'+chan+'YOR?;:'+chan+'YINC?').split(';')
+            answer, scale = parts[0], parts[1:]
+
+        head = answer.split(',')
+
+        return {
+            'xstart': float(head[0]),
+            'xstop': float(head[1]),
+            'points': int(float(head[2])),
+            'values': int(float(head[3])) if len(head) > 3 else 1,
+            'yorigin': float(scale[0]),
+            'yincrement': float(scale[1]),
+        }
+
+
+    #####################################################################
+    # Get waveform of channel in binary format
+    # Data_format:
+    # - UINT,8  - 8 bit samples, lowest traffic
+    # - UINT,16 - 16 bit samples
+    # - REAL,32 - float samples in V
+    # Out:
+    # - optional preallocated float64 array for voltage values
+    # Returns tuple (time axis in s, voltage in V) of NumPy arrays
+    #####################################################################
+    @_traced
+    def getWaveform(self, session, channel, data_format='UINT,8', out=None):
+
+        dtype = np.dtype(self.WAVEFORM_FORMATS[data_format])
+
+        self._write(session, 'FORM '+data_format+';:FORM:BORD LSBF')
+
+        head = self.getWaveformHeader(session, channel, data_format)
+
+        points = head['points']
+        count = points * head['values']
+
+        raw = np.empty(count, dtype)
+
+        self._write(session, 'CHAN'+str(channel)+':DATA?')
+        nbytes = self._readBlockInto(session, raw)
+        count = nbytes // dtype.itemsize
+
+        if out is None:
+            out = np.empty(count, np.float64)
+        else:
+            out = out[:count]
+
+        # Scale samples in place without intermediate copies
+        np.multiply(raw[:count], head['yincrement'], out=out, casting='unsafe')
+        out += head['yorigin']
+
+        points = count // head['values']
+
+        xtime = np.arange(points, dtype=np.float64)
+        xtime *= (head['xstop'] - head['xstart']) / points
+        xtime += head['xstart']
+
+        if head['values'] > 1:
+            out = out.reshape(points, head['values'])
+
+        return xtime, out
+
+
+    #####################################################################
+    # Download long record of channel to waveform file in chunks
+    # Samples are written directly to memory mapped file, so RAM usage
+    # is bounded by chunk_size (see openWaveformFile)
+    # - points - record length (CHAN:DATA:POIN: DEF, MAX, DMAX),
+    #            None - keep current setting
+    # - retries - number of new requests after timeout in this call,
+    #             already written bytes are skipped
+    # - resume_token - token of acquisition stored in file header
+    #                  (None - file is always written from start).
+    #                  Incomplete file with same token and format is
+    #                  continued; caller asserts with token that record
+    #                  is the same (acquisition stopped, not repeated),
+    #                  scope can not check it
+    # Acquisition has to be stopped, so record does not change
+    # Returns header dict of file
+    #####################################################################
+    @_traced
+    def downloadWaveform(self, session, channel, file_name, data_format='UINT,8', points=None, chunk_size=1024*1024, retries=3, resume_token=None):
+
+        dtype = np.dtype(self.WAVEFORM_FORMATS[data_format])
+
+        if points is not None:
+            self._writeSetting(session, 'CHAN'+str(channel)+':DATA:POIN', points)
+
+        self._write(session, 'FORM '+data_format+';:FORM:BORD LSBF')
+
+        head = self.getWaveformHeader(session, channel, data_format)
+        head.update({'channel': channel, 'format': data_format, 'dtype': dtype.str,
+                     'count': head['points'] * head['values'], 'token': resume_token, 'written': 0})
+
+        nbytes = head['count'] * dtype.itemsize
+
+        if resume_token is not None and os.path.exists(file_name):
+            try:
+                old, raw = openWaveformFile(file_name)
+                del raw
+                if {k: v for k, v in old.items() if k != 'written'} == {k: v for k, v in head.items() if k != 'written'}:
+                    head['written'] = old['written']
+            except (ValueError, OSError):
+                pass
+
+        if head['written'] == 0:
+            with open(file_name, 'wb') as target:
+                target.truncate(WAVEFORM_FILE_HEADER + nbytes)
+            _saveWaveformHeader(file_name, head)
+
+        elif head['written'] < nbytes:
+            log.info("Resuming download of %s at %d of %d bytes", file_name, head['written'], nbytes)
+
+        data = np.memmap(file_name, dtype=np.uint8, mode='r+', offset=WAVEFORM_FILE_HEADER, shape=(nbytes,))
+        attempt = 0
+
+        try:
+            while head['written'] < nbytes:
+
+                try:
+                    self._write(session, 'CHAN'+str(channel)+':DATA?')
+
+                    if self._readBlockHeader(session) != nbytes:
+                        raise ValueError("Record length of channel {0} has changed".format(channel))
+
+                    pos = 0
+
+                    for chunk in self._readBlockChunks(session, nbytes, chunk_size):
+
+                        end = pos + len(chunk)
+
+                        if end > head['written']:
+                            data[head['written']:end] = np.frombuffer(chunk, np.uint8, offset=head['written'] - pos if head['written'] > pos else 0)
+                            data.flush()
+
+                            head['written'] = end
+                            _saveWaveformHeader(file_name, head)
+
+                        pos = end
+
+                except _pyvisa().errors.VisaIOError as e:
+
+                    if e.abbreviation != 'VI_ERROR_TMO' or attempt >= retries:
+                        raise
+
+                    attempt = attempt + 1
+
+                    log.warning("Timeout at %d of %d bytes, requesting record again (%d/%d)", head['written'], nbytes, attempt, retries)
+
+                    session.clear()
+
+        finally:
+            del data
+
+        log.info("Downloaded %d samples of channel %d to %s", head['count'], channel, file_name)
+
+        return head
+
+
+    #####################################################################
+    # Capture several channels with one acquisition
+    # - channels - list of channels (from 1 to 4), are turned on
+    # - data_format - see getWaveform
+    # - acquire - False - read current records without new acquisition
+    # Returns tuple (time axis in s, 2-D array of voltages in V with
+    # one row per channel in order of channels)
+    #####################################################################
+    @_traced
+    def captureChannels(self, session, channels, data_format='UINT,8', acquire=True, timeout=30):
+
+        with self.batch(session):
+            for channel in channels:
+                self.setChannelState(session, channel, 1)
+
+        if acquire:
+            self.acquireSingle(session, timeout)
+
+        head = self.getWaveformHeader(session, channels[0], data_format)
+
+        volts = np.empty((len(channels), head['points'] * head['values']), np.float64)
+
+        for row, channel in enumerate(channels):
+            xtime, values = self.getWaveform(session, channel, data_format, out=volts[row])
+
+        return xtime, volts[:, :values.size]
+
+
+    #####################################################################
+    # Pipelined single acquisitions of channel
+    # Next single acquisition is armed as soon as record of previous one
+    # is read, decoding and consumers run in worker thread meanwhile
+    # - count - number of acquisitions
+    # - callbacks - function or list of functions called in worker
+    #               thread as callback(index, xtime, volts); volts is
+    #               preallocated buffer which is reused after return
+    # - buffers - number of preallocated buffers (queue depth)
+    # Returns dict with captures, elapsed (s), rate (captures/s) and
+    # time spent in acquisition, transfer and waiting for free buffer
+    #####################################################################
+    @_traced
+    def pipelineAcquisitions(self, session, channel, count, callbacks, data_format='UINT,8', buffers=4, timeout=30):
+
+        if callable(callbacks):
+            callbacks = [callbacks]
+
+        dtype = np.dtype(self.WAVEFORM_FORMATS[data_format])
+
+        self.setChannelState(session, channel, 1)
+        self._write(session, 'FORM '+data_format+';:FORM:BORD LSBF')
+
+        head = self.getWaveformHeader(session, channel, data_format)
+        points = head['points'] * head['values']
+
+        xtime = np.arange(head['points'], dtype=np.float64)
+        xtime *= (head['xstop'] - head['xstart']) / head['points']
+        xtime += head['xstart']
+
+        raw = np.zeros((buffers, points), dtype)
+        volts = np.empty((buffers, points), np.float64)
+
+        free = queue.Queue()
+        full = queue.Queue(maxsize=buffers)
+        errors = []
+
+        for slot in range(buffers):
+            free.put(slot)
+
+        def worker():
+            while True:
+                item = full.get()
+                if item is None:
+                    break
+                index, slot = item
+                try:
+                    np.multiply(raw[slot], head['yincrement'], out=volts[slot], casting='unsafe')
+                    volts[slot] += head['yorigin']
+                    for callback in callbacks:
+                        callback(index, xtime, volts[slot])
+                except Exception as e:
+                    errors.append(e)
+                free.put(slot)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+
+        stats = {'captures': 0, 'acquire_time': 0.0, 'transfer_time': 0.0, 'stall_time': 0.0}
+        start = time.perf_counter()
+
+        try:
+            for index in range(count):
+
+                if errors:
+                    break
+
+                mark = time.perf_counter()
+                slot = free.get()
+
+                stats['stall_time'] = stats['stall_time'] + time.perf_counter() - mark
+
+                mark = time.perf_counter()
+                self.acquireSingle(session, timeout)
+
+                stats['acquire_time'] = stats['acquire_time'] + time.perf_counter() - mark
+
+                mark = time.perf_counter()
+                self._write(session, 'CHAN'+str(channel)+':DATA?')
+                self._readBlockInto(session, raw[slot])
+
+                stats['transfer_time'] = stats['transfer_time'] + time.perf_counter() - mark
+
+                full.put((index, slot))
+                stats['captures'] = stats['captures'] + 1
+
+        finally:
+            full.put(None)
+            thread.join()
+
+        stats['elapsed'] = time.perf_counter() - start
+        stats['rate'] = stats['captures'] / stats['elapsed'] if stats['elapsed'] else 0.0
+
+        log.info("Pipeline: %d captures in %.2f s (%.1f captures/s), acquisition %.2f s, transfer %.2f s, stalled %.2f s",
+                 stats['captures'], stats['elapsed'], stats['rate'], stats['acquire_time'], stats['transfer_time'], stats['stall_time'])
+
+        if errors:
+            raise errors[0]
+
+        return stats
+
+
+    #####################################################################
+    # Arm count acquisitions into segmented memory in one run
+    #   with self._acquireSegments(session, 1, 100, 120) as count:
+    #       (read segments)
+    # Single acquisition and segmented memory off are restored on exit,
+    # also if acquisition or download fails
+    #####################################################################
+    @contextlib.contextmanager
+    def _acquireSegments(self, session, channel, count, timeout):
+
+        try:
+            with self.batch(session):
+                self.setChannelState(session, channel, 1)
+                self._writeSetting(session, 'ACQ:SEGM:STAT', 'ON')
+                self._write(session, 'ACQ:NSIN:COUN '+str(count))
+
+            self.waitOperation(session, 'RUNS', timeout)
+
+            available = int(self._query(session, 'ACQ:AVA?'))
+
+            if available < count:
+                log.warning("Segmented memory contains only %d of %d acquisitions", available, count)
+
+            yield min(count, available)
+
+        finally:
+            self._write(session, 'ACQ:NSIN:COUN 1')
+            self._writeSetting(session, 'ACQ:SEGM:STAT', 'OFF')
+
+
+    #####################################################################
+    # Select segment of history (0 - newest, negative - older ones)
+    # Returns trigger time of segment relative to newest one in s
+    #####################################################################
+    def _selectSegment(self, session, channel, index):
+
+        chan = 'CHAN'+str(channel)+':HIST:'
+
+        return float(self._query(session, chan+'CURR '+str(index)+';:'+chan+'TSR?'))
+
+
+    #####################################################################
+    # Capture burst of acquisitions with segmented (history) memory
+    # All segments are acquired at trigger rate of oscilloscope in one
+    # run and downloaded afterwards
+    # - count - number of segments
+    # - data_format - UINT,8 or UINT,16 (see getWaveform)
+    # Returns tuple (time axis in s, trigger times of segments relative
+    # to newest one in s, 2-D array of voltages in V with one row per
+    # segment, oldest first)
+    #####################################################################
+    @_traced
+    def captureSegments(self, session, channel, count, data_format='UINT,8', timeout=120):
+
+        dtype = np.dtype(self.WAVEFORM_FORMATS[data_format])
+
+        with self._acquireSegments(session, channel, count, timeout) as count:
+
+            self._write(session, 'FORM '+data_format+';:FORM:BORD LSBF')
+
+            head = self.getWaveformHeader(session, channel, data_format)
+            points = head['points'] * head['values']
+
+            raw = np.zeros((count, points), dtype)
+            times = np.empty(count, np.float64)
+
+            for segment in range(count):
+
+                times[segment] = self._selectSegment(session, channel, segment - count + 1)
+
+                self._write(session, 'CHAN'+str(channel)+':DATA?')
+                self._readBlockInto(session, raw[segment])
+
+        # Scale all segments at once
+        volts = raw * head['yincrement']
+        volts += head['yorigin']
+
+        xtime = np.arange(head['points'], dtype=np.float64)
+        xtime *= (head['xstop'] - head['xstart']) / head['points']
+        xtime += head['xstart']
+
+        log.info("Captured %d segments of channel %d over %.3f s", count, channel, -times[0] if count else 0.0)
+
+        return xtime, times, volts
+
+
+    #####################################################################
+    # Quick measure results of burst of acquisitions captured with
+    # segmented (history) memory (no waveform transfer)
+    # Returns tuple (trigger times of segments relative to newest one
+    # in s, NumPy structured array with quickMeas.DTYPE records,
+    # oldest first)
+    #####################################################################
+    @_traced
+    def getSegmentMeasurements(self, session, channel, count, timeout=120):
+
+        self.setQuickMeasState(session, 1)
+
+        with self._acquireSegments(session, channel, count, timeout) as count:
+
+            results = np.zeros(count, dtype=quickMeas.DTYPE)
+            times = np.empty(count, np.float64)
+
+            for segment in range(count):
+
+                times[segment] = self._selectSegment(session, channel, segment - count + 1)
+                results[segment] = self.getQuickMeasAll(session).astuple()
+
+        return times, results
+
+
+    #####################################################################
+    # Mean, RMS, Vpp, peaks and frequency of several channels
+    # captured with one acquisition (see captureChannels, waveformStats)
+    # Returns dict {channel: {'mean': V, 'rms': V, 'vpp': V, 'vmax': V,
+    #                         'vmin': V, 'frequency': Hz}}
+    #####################################################################
+    @_traced
+    def getChannelStats(self, session, channels, data_format='UINT,8', acquire=True, timeout=30):
+
+        xtime, volts = self.captureChannels(session, channels, data_format, acquire, timeout)
+
+        stats = waveformStats(xtime, volts)
+
+        return {channel: {name: float(values[row]) for name, values in stats.items()} for row, channel in enumerate(channels)}
+
+
+    ########################################################################################
+    #                                                                                      #
+    #               Function uses to get measured values                                   #
+    #                                                                                      #
+    ########################################################################################
+
+
+    #####################################################################
+    # Get voltage function
+    # Reset:
+    # - True - reset oscilloscope before setup
+    # - False - keep settings, only changed ones are written
+    # Scale:
+    # - starting vertical scale in V
+    #####################################################################
+    @_traced
+    def getVoltage(self, session, channel, reset=True, scale=0.5):
+
+        self.setupVoltage(session, channel, reset)
+
+        return round(self.getVoltmeterValue(session, channel, scale), 1)
+
+
+    #####################################################################
+    # Setup channel and voltmeter for getVoltage
+    #####################################################################
+    def setupVoltage(self, session, channel, reset=True):
+
+        with self.batch(session):
+
+            if reset:
+                self.resetDevice(session)
+            else:
+                self.setAcqState(session, "RUN")
+
+            self.setChannelState(session, channel, 1)
+            self.setChannelCoupling(session, channel, 'DC')
+
+            self.setVoltmeterState(session, 1)
+            self.setVoltmeterParam(session, channel, 'DC')
+
+    
+    #####################################################################
+    # Get voltage Peak-to-peak 
+    # Mode:
+    # - 'STAT' - maximum of count acquisitions from measurement
+    #            statistics of oscilloscope (one query)
+    # - 'LOOP' - host-side search over count single acquisitions
+    # Reset:
+    # - True - reset oscilloscope before setup
+    # - False - keep settings, only changed ones are written
+    # Voltage:
+    # - starting vertical scale in V
+    # Returns maximum Vpp in mV
+    #####################################################################
+    @_traced
+    def getVoltagePP(self, session, channel, bandwidth, htime, mode='STAT', count=50, reset=True, voltage=0.010):
+
+        self.setupQuickMeas(session, channel, 'AC', bandwidth, htime, voltage, reset)
+
+        self.setTriggerFindLevel(session)
+        self.waitOperation(session)
+
+        voltage = self.autorangeVertical(session, channel, voltage, lambda: self._measureQuickVpp(session)).scale
+
+        if mode == 'STAT':
+
+            vpp = self.getStatisticVpp(session, channel, count)
+
+            if vpp is not None:
+                return vpp
+
+            log.info("Statistics result is clipped, using host-side search")
+
+        return self.getHostVpp(session, channel, voltage, count)
+
+
+    #####################################################################
+    # Setup channel and quick measure for getVoltagePP and getVoltageDC
+    #####################################################################
+    def setupQuickMeas(self, session, channel, coupling, bandwidth, htime, voltage, reset=True):
+
+        with self.batch(session):
+
+            if reset:
+                self.resetDevice(session)
+
+            self.setChannelState(session, channel, 1)
+            self.setChannelCoupling(session, channel, coupling)
+
+            self.setVertical(session, channel, voltage)
+            self.setHorizontal(session, htime)
+            self.setBandwidth(session, channel, bandwidth)
+            self.setQuickMeasState(session, 1)
+
+
+    #####################################################################
+    # Get maximum Vpp from measurement statistics over count acquisitions
+    # Returns Vpp in mV or None if result is clipped
+    #####################################################################
+    @_traced
+    def getStatisticVpp(self, session, channel, count=50, timeout=120):
+
+        self._setupStatistics(session, channel, count)
+
+        # Single acquisition is restored also after timeout
+        try:
+            self.waitOperation(session, 'RUNS', timeout)
+        finally:
+            self._write(session, 'ACQ:NSIN:COUN 1')
+
+        return self._readStatisticVpp(session, count)
+
+
+    #####################################################################
+    # Setup peak-to-peak measurement statistics over count acquisitions
+    #####################################################################
+    def _setupStatistics(self, session, channel, count):
+
+        log.info("Measuring maximum Vpp with statistics over %d acquisitions...", count)
+
+        self._write(session, 'MEAS1:SOUR CH'+str(channel)+';:MEAS1:MAIN PEAK;:MEAS1:ENAB ON')
+        self._write(session, 'MEAS1:STAT ON;:MEAS1:STAT:WEIG '+str(count)+';:MEAS1:STAT:RES')
+        self._write(session, 'ACQ:NSIN:COUN '+str(count))
+
+
+    #####################################################################
+    # Read maximum Vpp of statistics after acquisitions are complete
+    #####################################################################
+    def _readStatisticVpp(self, session, count):
+
+        answer = self._query(session, 'MEAS1:RES:PPE?;:MEAS1:RES:WFMC?').split(';')
+
+        vpp = float(answer[0])
+
+        if len(answer) > 1 and int(float(answer[1])) < count:
+            log.warning("Statistics contain only %s acquisitions", answer[1].strip())
+
+        if (vpp >= 9.91e+37) | (vpp < 0):
+            return None
+
+        return round(vpp*1000, 1)
+
+
+    #####################################################################
+    # Get maximum Vpp with host-side search over single acquisitions
+    # Vertical scale is settled again if Vpp is clipped more than 10 times
+    # Returns Vpp in mV
+    #####################################################################
+    @_traced
+    def getHostVpp(self, session, channel, voltage, count=50):
+
+        search = self._startHostVpp(count)
+
+        while search['i'] < count:
+
+            self.acquireSingle(session)
+
+            if self._hostVppStep(search, self._query(session, 'MEAS:ARES?')):
+                ranger = self.autorangeVertical(session, channel, voltage, lambda: self._measureQuickVpp(session))
+                voltage = self._hostVppRanged(search, ranger)
+
+        return search['result']
+
+
+    #####################################################################
+    # State of host-side Vpp search (shared with AsyncOscillograph)
+    #####################################################################
+    def _startHostVpp(self, count):
+
+        log.info("Searching maximum Vpp in %d cycles...", count)
+
+        return {'i': 1, 'result': 0, 'clipping': 0}
+
+
+    #####################################################################
+    # Pass MEAS:ARES? answer of one acquisition to host-side Vpp search
+    # Returns True if vertical scale has to be autoranged
+    #####################################################################
+    def _hostVppStep(self, search, answer):
+
+        vpp, clipped = self._quickVppSpan(answer)
+
+        search['i'] = search['i'] + 1
+
+        if clipped:
+
+            search['clipping'] = search['clipping'] + 1
+            log.debug("VPP Clipping counter: %d", search['clipping'])
+
+            return search['clipping'] > 10
+
+        log.debug("VPP = %s", vpp)
+
+        search['result'] = max(search['result'], round(vpp * 1000, 1))
+
+        return False
+
+
+    #####################################################################
+    # Restart host-side Vpp search after autorange
+    # Returns new vertical scale
+    #####################################################################
+    def _hostVppRanged(self, search, ranger):
+
+        if ranger.overrange:
+            raise RuntimeError("Vpp is clipped at maximum vertical scale")
+
+        log.warning("Set new voltage scale to oscilloscope: %s", ranger.scale)
+
+        search['clipping'] = 0
+        search['i'] = 1
+
+        return ranger.scale
+
+    
+    #####################################################################
+    # Autorange probe: quick measure Vpp of single acquisition
+    #####################################################################
+    def _measureQuickVpp(self, session):
+
+        self.acquireSingle(session)
+
+        return self._quickVppSpan(self._query(session, 'MEAS:ARES?'))
+
+
+    #####################################################################
+    # Span of quick measure Vpp for autorange (None if clipped)
+    #####################################################################
+    def _quickVppSpan(self, answer):
+
+        vpp = float(answer.split(',')[0])
+
+        if (vpp >= 9.91e+37) | (vpp < 0):
+            return None, 1
+
+        return vpp, 0
+
+
+    #####################################################################
+    # Autorange probe: quick measure peaks of single acquisition
+    #####################################################################
+    def _measureQuickPeaks(self, session):
+
+        self.acquireSingle(session)
+
+        return self._quickPeaksSpan(self._query(session, 'MEAS:ARES?'))
+
+
+    #####################################################################
+    # Span of quick measure peaks for autorange (None if clipped)
+    #####################################################################
+    def _quickPeaksSpan(self, answer):
+
+        result_arr = answer.split(',')
+        peak = max(abs(float(result_arr[1])), abs(float(result_arr[2])))
+
+        if peak >= 9.91e+37:
+            return None, 1
+
+        # Channel offset is 0, so screen has to fit +/- peak
+        return 2 * peak, 0
+
+
+    #####################################################################
+    # Fucntion to get VULpe value 
+    # Voltage:
+    # - starting vertical scale in V
+    # Reset:
+    # - True - reset oscilloscope before setup
+    # - False - keep settings, only changed ones are written
+    #####################################################################
+    @_traced
+    def getVoltageDC(self, session, channel, bandwidth, htime, voltage, reset=True):
+
+        self.setupQuickMeas(session, channel, 'DC', bandwidth, htime, voltage, reset)
+
+        self.setTriggerFindLevel(session)
+        self.waitOperation(session)
+
+        # Last autorange step leaves acquisition at settled scale
+        self.autorangeVertical(session, channel, voltage, lambda: self._measureQuickPeaks(session))
+
+        return self.getQuickMeasVULpe(session)
+
+
+
+    ########################################################################################
+    #                                                                                      #
+    #               Functions to run test plans                                            #
+    #                                                                                      #
+    ########################################################################################
+
+    # Order of measurement groups in test plan
+    TEST_TYPES = ('VOLTAGE', 'DC', 'VPP')
+
+    # Keys needed by measurement of every type
+    TEST_KEYS = {
+        'VOLTAGE': ('channel',),
+        'DC': ('channel', 'bandwidth', 'htime'),
+        'VPP': ('channel', 'bandwidth', 'htime'),
+    }
+
+    #####################################################################
+    # Run list of measurements with shared setup
+    # Plan - list of dicts:
+    # - 'type' - 'VOLTAGE' (getVoltage, V), 'DC' (getVoltageDC, peaks in V)
+    #            or 'VPP' (getVoltagePP, mV)
+    # - 'channel' - from 1 to 4
+    # - 'bandwidth', 'htime' - see getVoltagePP (not used by 'VOLTAGE')
+    # - 'range' - expected (low, high) of result, used as pass/fail limits
+    #             and for starting vertical scale (optional)
+    # - 'voltage' - starting vertical scale in V (optional)
+    # - 'mode', 'count' - see getVoltagePP (optional)
+    # - 'name' - name of row in results (optional)
+    # Measurements are grouped by type, bandwidth, timebase and channel,
+    # oscilloscope is reset only once (reset=True), every measurement
+    # writes only settings which differ from previous one
+    # Plan is checked before reset (ValueError), failed measurement is
+    # reported in its row and does not stop the plan
+    # Returns list of result dicts in order of plan
+    #####################################################################
+    @_traced
+    def runTestPlan(self, session, plan, reset=True):
+
+        for test in plan:
+            self._checkTest(test)
+
+        order = sorted(range(len(plan)), key=lambda i: self._testSetupKey(plan[i]))
+
+        if reset:
+            self.resetDevice(session)
+
+        results = [None] * len(plan)
+
+        for i in order:
+            results[i] = self._runTest(session, plan[i])
+
+        return results
+
+
+    #####################################################################
+    # Check type and keys of test plan entry
+    #####################################################################
+    def _checkTest(self, test):
+
+        kind = str(test.get('type', '')).upper()
+
+        if kind not in self.TEST_KEYS:
+            raise ValueError("Unknown test type: "+str(test.get('type')))
+
+        missing = [key for key in self.TEST_KEYS[kind] if key not in test]
+
+        if missing:
+            raise ValueError("Test "+str(test.get('name', kind))+" needs "+", ".join(missing))
+
+
+    #####################################################################
+    # Sort key of measurement, equal keys share setup
+    #####################################################################
+    def _testSetupKey(self, test):
+
+        return (self.TEST_TYPES.index(test['type'].upper()), str(test.get('bandwidth', '')),
+                float(test.get('htime', 0)), test['channel'])
+
+
+    #####################################################################
+    # Starting vertical scale from expected span of signal in V
+    #####################################################################
+    def _testScale(self, test, span, default):
+
+        if 'voltage' in test:
+            return test['voltage']
+
+        if not span:
+            return default
+
+        return autorange.SCALES[autorange(default).fit(span)]
+
+
+    #####################################################################
+    # Run one measurement of test plan (without reset)
+    #####################################################################
+    def _runTest(self, session, test):
+
+        kind = test['type'].upper()
+        channel = test['channel']
+        low, high = test.get('range', (None, None))
+        limit = max(abs(low or 0), abs(high or 0))
+
+        row = {'name': test.get('name', kind+' CH'+str(channel)), 'type': kind, 'channel': channel,
+               'value': None, 'low': low, 'high': high, 'passed': None, 'error': None}
+
+        start = time.perf_counter()
+
+        try:
+            if kind == 'VOLTAGE':
+                scale = self._testScale(test, 2 * limit, 0.5)
+                row['value'] = self.getVoltage(session, channel, reset=False, scale=scale)
+
+            elif kind == 'DC':
+                voltage = self._testScale(test, 2 * limit, 1.0)
+                row['value'] = self.getVoltageDC(session, channel, test['bandwidth'], test['htime'], voltage, reset=False)
+
+            else:
+                voltage = self._testScale(test, (high or 0) / 1000, 0.010)
+                row['value'] = self.getVoltagePP(session, channel, test['bandwidth'], test['htime'], test.get('mode', 'STAT'),
+                                                 test.get('count', 50), reset=False, voltage=voltage)
+
+        except Exception as e:
+            log.error("Test %s failed: %s", row['name'], e)
+            row['error'] = str(e) or type(e).__name__
+            row['passed'] = False
+            self.flushStateCache()
+
+        row['time'] = time.perf_counter() - start
+
+        if row['value'] is not None and (low is not None or high is not None):
+            values = row['value'] if isinstance(row['value'], list) else [row['value']]
+            row['passed'] = all((low is None or value >= low) and (high is None or value <= high) for value in values)
+
+        return row
+
+
+    #####################################################################
+    # Print results of runTestPlan as table
+    #####################################################################
+    def printTestPlan(self, results):
+
+        print("{0:<20} {1:<8} {2:>3} {3:>20} {4:>10} {5:>10} {6:>6} {7:>8}".format('NAME', 'TYPE', 'CH', 'VALUE', 'LOW', 'HIGH', 'PASS', 'TIME'))
+
+        for row in results:
+            print("{0:<20} {1:<8} {2:>3} {3:>20} {4:>10} {5:>10} {6:>6} {7:>8.3f}".format(
+                row['name'], row['type'], row['channel'], str(row['value'] if row['error'] is None else 'ERROR'),
+                str(row['low']), str(row['high']), str(row['passed']), row['time']))
+
+
+
+############################################################
+#  Pool of oscilloscopes sharing one VISA ResourceManager
+#  Sessions stay open per resource string, measurements of
+#  different scopes run concurrently in thread pool, one
+#  measurement at a time per scope:
+#
+#    with oscillographPool() as pool:
+#        results = pool.map('getVoltage', addresses, 1)
+#
+#  raise_batch_errors - measurement fails if instrument
+#  rejects command of its setup (see oscillograph.batch)
+############################################################
+class oscillographPool(object):
+
+    def __init__(self, max_workers=16, transport='INSTR', visa_library=None, raise_batch_errors=False):
+
+        self.rm = None
+        self.visa_library = visa_library if visa_library is not None else oscillograph.visa_library
+        self.max_workers = max_workers
+        self.transport = transport
+        self.raise_batch_errors = raise_batch_errors
+        self.executor = None
+
+        # {resource: {'lock': Lock, 'scope': oscillograph, 'session': session}}
+        self.instruments = {}
+        self.lock = threading.Lock()
+
+
+    def __enter__(self):
+
+        return self
+
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+
+    #####################################################################
+    # Get pool entry of instrument (created on first use)
+    #####################################################################
+    def _entry(self, address):
+
+        resource = resourceName(address, self.transport)
+
+        with self.lock:
+
+            if self.rm is None:
+                self.rm = _pyvisa().ResourceManager(self.visa_library)
+
+            entry = self.instruments.get(resource)
+
+            if entry is None:
+                entry = {'lock': threading.Lock(), 'scope': oscillograph(self.rm), 'session': None}
+                entry['scope'].raise_batch_errors = self.raise_batch_errors
+                self.instruments[resource] = entry
+
+        return entry
+
+
+    #####################################################################
+    # Open long-lived session to instrument
+    # Returns (oscillograph, session)
+    #####################################################################
+    def open(self, address):
+
+        entry = self._entry(address)
+
+        with entry['lock']:
+            self._connect(entry, address)
+
+        return entry['scope'], entry['session']
+
+
+    def _connect(self, entry, address):
+
+        if entry['session'] is None:
+
+            entry['session'] = entry['scope'].connect(address, self.transport)
+
+            if entry['session'] is None:
+                raise ConnectionError("Can not open connection with "+str(address))
+
+
+    #####################################################################
+    # Run oscillograph method on instrument (blocks while instrument is
+    # busy with other measurement)
+    #   pool.run('192.168.1.106', 'getVoltagePP', 1, '20', 0.001)
+    #####################################################################
+    def run(self, address, method, *args, **kwargs):
+
+        entry = self._entry(address)
+
+        with entry['lock']:
+            self._connect(entry, address)
+            return getattr(entry['scope'], method)(entry['session'], *args, **kwargs)
+
+
+    #####################################################################
+    # Run method in thread pool
+    # Returns concurrent.futures.Future
+    #####################################################################
+    def submit(self, address, method, *args, **kwargs):
+
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        return self.executor.submit(self.run, address, method, *args, **kwargs)
+
+
+    #####################################################################
+    # Run same method with same arguments on many instruments
+    # - return_exceptions - return exception of failed instrument as its
+    #                       result instead of raising it
+    # Returns {address: result}
+    #####################################################################
+    def map(self, method, addresses, *args, return_exceptions=False, **kwargs):
+
+        futures = [(address, self.submit(address, method, *args, **kwargs)) for address in addresses]
+
+        results = {}
+
+        for address, future in futures:
+
+            try:
+                results[address] = future.result()
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                log.error("%s: %s", address, e)
+                results[address] = e
+
+        return results
+
+
+    #####################################################################
+    # Close all sessions and shared ResourceManager
+    #####################################################################
+    def close(self):
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+        with self.lock:
+
+            for entry in self.instruments.values():
+                with entry['lock']:
+                    if entry['session'] is not None:
+                        entry['session'].close()
+                        entry['session'] = None
+
+            self.instruments.clear()
+
+            if self.rm is not None:
+                self.rm.close()
+                self.rm = None
+
+
+
+############################################################
+#  Asyncio facade of oscillograph
+#  Blocking VISA I/O runs in executor, waits poll status
+#  with asyncio.sleep. Measurements accept timeout (s) and
+#  may be cancelled, one measurement at a time per scope:
+#
+#    scope = AsyncOscillograph(oscillograph(rm), session)
+#    vpp = await scope.getVoltagePP(1, '20', 0.001, timeout=30)
+############################################################
+class AsyncOscillograph(object):
+
+    def __init__(self, scope, session, executor=None):
 
-        print("INFO: Reset oscilloscope settings \n\r")
-        session.write('*RST')
+        self.scope = scope
+        self.session = session
+        self.executor = executor
+
+        # asyncio is imported on first use (fast import of rtb2002)
+        import asyncio
+
+        self.lock = asyncio.Lock()
 
 
     #####################################################################
-    # Get OPC value 
+    # Run blocking function in executor
     #####################################################################
-    def getOPC(self, session):
+    async def _call(self, func, *args, **kwargs):
 
-        print("INFO: Getting OPC bit\n\r")
+        import asyncio
 
-        answer = session.query('*OPC?')
+        future = asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
 
-        print("INFO: OPC bit value:"+str(answer)+"\n\r")
-
-        return answer
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # Blocking VISA call can not be interrupted, wait until it is
+            # finished so next command does not interleave with it
+            await asyncio.wait([future])
+            raise
 
 
     #####################################################################
-    # Clear status
+    # Run coroutine function exclusively on scope with deadline
+    # Coroutine is created after lock is taken, so it is not left
+    # unawaited if deadline expires while waiting for lock
     #####################################################################
-    def clearStatus(self, session):
-        
-        print("INFO: Clear status \n\r")
-        session.write('*CLS')
+    async def _run(self, timeout, func, *args):
 
+        import asyncio
 
-    #####################################################################
-    # Get screenshot from device
-    #####################################################################
-    def getScreenshot(self, session, screen_name):
+        return await asyncio.wait_for(self._locked(func, *args), timeout)
 
-        try:
 
-            session.write("MMEM:CDIR '/USB_FRONT/'\n")
+    async def _locked(self, func, *args):
 
-            session.write("MMEM:DEL 'SCREEN.png'")
-            
-            self.getOPC(session)
-            self.clearStatus(session)
+        import asyncio
 
-            session.write("HCOP:LANG PNG;:MMEM:NAME 'SCREEN'")
+        async with self.lock:
+            try:
+                return await func(*args)
+            except asyncio.CancelledError:
+                # Settings of interrupted measurement are unknown
+                self.scope.batches.pop(self.session, None)
+                self.scope.flushStateCache(self.session)
+                raise
 
-            session.write("HCOP:IMM\n")
 
-            self.getOPC(session)
+    async def _write(self, command):
 
-            session.values_format.is_binary = True
-            session.values_format.datatype = 'B'
-            session.values_format.is_big_endian = False
-            session.values_format.container = bytearray
+        await self._call(self.scope._write, self.session, command)
 
-            img = session.query_values("MMEM:DATA? 'SCREEN.png'")
 
-            target = open(screen_name, 'wb')
-            target.write(img)
+    async def _query(self, command):
 
-            print("INFO: Getting screenshot from device: "+screen_name)
-            target.close()
+        return await self._call(self.scope._query, self.session, command)
 
-        except:
-            print("ERROR: Failed getting screenshot dfrom device")
 
+    #####################################################################
+    # Write command
+    #####################################################################
+    async def write(self, command, timeout=None):
 
+        await self._run(timeout, self._write, command)
 
-    ########################################################################################
-    #                                                                                      #
-    #               Functions for measurments setup                                        #
-    #                                                                                      #
-    ########################################################################################
 
     #####################################################################
-    #   Set vertical scale
-    #   Channel:
-    #   - from 1 to 4
-    #   Value:
-    #   - value in V
+    # Query command
     #####################################################################
-    def setVertical(self, session, channel, value):
-        
-        print("INFO: Set vertical scale to channel: "+str(channel)+" value:"+str(value))
-        session.write('CHAN'+str(channel)+':SCAL '+str(value))
+    async def query(self, command, timeout=None):
+
+        return await self._run(timeout, self._query, command)
 
 
     #####################################################################
-    # Set bandwidth 
-    #  'B20' -  20MHz band
-    #  'FULL' - full bandwidth
+    # Poll query until answer satisfies condition (see oscillograph)
     #####################################################################
-    def setBandwidth(self, session, channel, bandwidth):
-        
-        if bandwidth == '20':
-            bandwidth = 'B20'
-        else:
-            bandwidth = 'FULL'
+    async def _pollUntil(self, query, condition, timeout):
 
-        print("INFO: Set bandwidth to channel: "+str(channel)+" value:"+str(bandwidth))
-        session.write('CHAN'+str(channel)+':BAND '+str(bandwidth))
+        import asyncio
 
-    
-    #####################################################################
-    # Set time scale
-    # Value:
-    # - seconds
-    #####################################################################
-    def setHorizontal(self, session, value):
+        start = time.perf_counter()
+        delay = self.scope.poll_min_delay
 
-        session.write('TIM:SCAL '+str(value))
+        while not condition(await self._query(query)):
 
+            if time.perf_counter() - start > timeout:
+                raise TimeoutError("No response to '{0}' within {1} s".format(query, timeout))
 
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.scope.poll_max_delay)
+
+        self.scope.last_wait = time.perf_counter() - start
+
+        return self.scope.last_wait
 
-    ########################################################################################
-    #                                                                                      #
-    #               Functions for work with oscilloscope channels                          #
-    #                                                                                      #
-    ########################################################################################
 
     #####################################################################
-    # Set channel state
-    # - channel - number of channel
-    # - state - 1 - on
-    #         - 0 - off
+    # Wait until all pending operations are complete
     #####################################################################
-    def setChannelState(self, session, channel, state):
+    async def waitOperation(self, command=None, timeout=30):
 
-        if((state == 1) & (channel == 1)):
-            state = 'CHAN1:STAT ON'
-        elif((state == 0) & (channel == 1)):
-            state = 'CHAN1:STAT OFF'
+        prefix = command+';' if command else ''
 
-        if((state == 1) & (channel == 2)):
-            state = 'CHAN2:STAT ON'
-        elif((state == 0) & (channel == 21)):
-            state = 'CHAN2:STAT OFF'
+        await self._query(prefix+'*ESR?;*OPC')
 
-        if((state == 1) & (channel == 3)):
-            state = 'CHAN3:STAT ON'
-        elif((state == 0) & (channel == 3)):
-            state = 'CHAN3:STAT OFF'
+        wait = await self._pollUntil('*ESR?', lambda answer: int(answer) & 0x1, timeout)
 
-        if((state == 1) & (channel == 4)):
-            state = 'CHAN4:STAT ON'
-        elif((state == 0) & (channel == 4)):
-            state = 'CHAN4:STAT OFF'
+        log.debug("Operation complete in %.1f ms", wait * 1000)
 
-        session.write(state)
+        return wait
 
 
     #####################################################################
-    # Set coupling mode on channel on oscilloscope
+    # Start single acquisition and wait until it is complete
     #####################################################################
-    def setChannelCoupling(self, session, channel, coupling):
+    async def acquireSingle(self, timeout=30):
 
-        if coupling == 'DC':
-            coupling = 'DCL'
+        return await self.waitOperation('RUNS', timeout)
 
-        elif coupling == 'AC':
-            coupling = 'ACL'
 
-        else:
-            coupling = 'GND'
+    #####################################################################
+    # Wait until voltmeter result is available
+    #####################################################################
+    async def waitVoltmeterResult(self, timeout=10):
 
-        session.write('CHAN'+str(channel)+':COUP '+str(coupling))
+        wait = await self._pollUntil('DVM:RES:STAT?', self.scope._voltmeterReady, timeout)
 
+        log.debug("Voltmeter result ready in %.1f ms", wait * 1000)
+
+        return wait
 
-    ########################################################################################
-    #                                                                                      #
-    #               Functions to work with trigger options                                 #
-    #                                                                                      #
-    ########################################################################################
 
     #####################################################################
-    # Set trigger source 
+    # Settle vertical scale with autorange engine
+    # - measure - coroutine function returning (span in V, clipped)
     #####################################################################
-    def setTriggerSource(self, session, channel):
+    async def autorangeVertical(self, channel, scale, measure):
 
-        if channel == 1:
-            channel = 'CH1'
+        ranger = autorange(scale)
 
-        elif channel == 2:
-            channel = 'CH2'
+        await self._call(self.scope.setVertical, self.session, channel, ranger.scale)
 
-        elif channel == 3:
-            channel = 'CH3'
+        while True:
 
-        elif channel == 4:
-            channel = 'CH4'
+            amplitude, clipped = await measure()
 
-        session.write('TRIG:A:SOUR '+str(channel))
+            scale = ranger.next(amplitude, clipped)
 
+            if scale is None:
+                break
 
-    #####################################################################
-    # Function to find trigger level
-    #####################################################################
-    def setTriggerFindLevel(self, session):
+            await self._call(self.scope.setVertical, self.session, channel, scale)
 
-        session.write('TRIG:A:FIND')
+        self.scope.autorange_steps = ranger.steps
 
+        if ranger.overrange:
+            log.error("Signal is clipped at maximum vertical scale %s", ranger.scale)
+        else:
+            log.info("Vertical scale settled at %s in %d steps", ranger.scale, ranger.steps)
 
+        return ranger
 
-    ########################################################################################
-    #                                                                                      #
-    #               Functions to work with integrated digial voltmeter                     #
-    #                                                                                      #
-    ########################################################################################
 
-    #####################################################################
-    # On/off digital voltmeter
-    #####################################################################
-    def setVoltmeterState(self, session, state):
-        
-        if(state == 1):
-            state = 'DVM:ENAB ON'
-        else:
-            state = 'DVM:ENAB OFF'
+    async def _measureVoltmeter(self):
 
-        session.write(state)
+        await self.acquireSingle()
+        await self.waitVoltmeterResult()
 
+        return self.scope._voltmeterSpan(*await self._call(self.scope.readVoltmeter, self.session))
 
-    #####################################################################
-    # Set parameters of digital voltmeter
-    # Channel:
-    # - from 1 to 4
-    # Voltage_type:
-    # - DC
-    # - ACDCrms
-    # - ACRMs
-    # - OFF
-    #####################################################################
-    def setVoltmeterParam(self, session, channel, voltage_type):
 
-        if(channel == 1):
-            channel = 'DVM:SOUR CH1'
+    async def _measureQuickVpp(self):
 
-        elif(channel == 2):
-            channel = 'DVM:SOUR CH2'
+        await self.acquireSingle()
 
-        elif(channel == 3):
-            channel = 'DVM:SOUR CH3'
+        return self.scope._quickVppSpan(await self._query('MEAS:ARES?'))
 
-        elif(channel == 4):
-            channel = 'DVM:SOUR CH5'
 
-        session.write(channel)
+    async def _measureQuickPeaks(self):
 
+        await self.acquireSingle()
 
-        if(voltage_type == 'DC'):
-            voltage_type = 'DVM:TYPE DC'
+        return self.scope._quickPeaksSpan(await self._query('MEAS:ARES?'))
 
-        elif(voltage_type == 'ACDCrms'):
-            voltage_type = 'DVM:TYPE ACDC'
 
-        elif(voltage_type == 'ACRMs'):
-            voltage_type = 'DVM:TYPE ACRM'
+    #####################################################################
+    # Get voltage (see oscillograph.getVoltage)
+    #####################################################################
+    async def getVoltage(self, channel, reset=True, scale=0.5, timeout=None):
 
-        elif(voltage_type == 'OFF'):
-            voltage_type = 'DVM:TYPE OFF'    
+        return await self._run(timeout, self._getVoltage, channel, reset, scale)
 
-        session.write(voltage_type)
 
+    async def _getVoltage(self, channel, reset, scale):
 
-    #####################################################################
-    # Function returns voltmeter status
-    #####################################################################
-    def getVoltmeterStatus(self, session):
+        await self._call(self.scope.setupVoltage, self.session, channel, reset)
 
-        status = session.query('DVM:RES:STAT?')
-        status_arr = status.split(',')
+        await self.autorangeVertical(channel, scale, self._measureVoltmeter)
 
-        return status_arr[1].replace('\\n\'','')
+        voltage, state_bin = await self._call(self.scope.readVoltmeter, self.session)
+
+        await self._write('RUNC')
+
+        return round(round(voltage, 3), 1)
 
 
     #####################################################################
-    # Function used for print voltmeter status
+    # Get voltage Peak-to-peak in mV (see oscillograph.getVoltagePP)
     #####################################################################
-    def printVoltmeterStatus(self, session):
-
-        state_bin = int(self.getVoltmeterStatus(session))
+    async def getVoltagePP(self, channel, bandwidth, htime, mode='STAT', count=50, reset=True, voltage=0.010, timeout=None):
 
-        if((state_bin & 0x1 ) == 1):
-            print ("Result is valid")
-        elif((state_bin & 0x1 ) == 0):
-            print ("Result is invalid")
+        return await self._run(timeout, self._getVoltagePP, channel, bandwidth, htime, mode, count, reset, voltage)
 
 
-        if((state_bin & 0x2 ) == 2):
-            print ("No result avaliable")
-        elif((state_bin & 0x2 ) == 0):
-            print ("Result is avaliable")
+    async def _getVoltagePP(self, channel, bandwidth, htime, mode, count, reset, voltage):
 
+        await self._call(self.scope.setupQuickMeas, self.session, channel, 'AC', bandwidth, htime, voltage, reset)
 
-        if((state_bin & 0x4 ) == 4):
-            print ("No period found")       
-        elif((state_bin & 0x4 ) == 0):
-            print ("Period found")          
+        await self._call(self.scope.setTriggerFindLevel, self.session)
+        await self.waitOperation()
 
+        voltage = (await self.autorangeVertical(channel, voltage, self._measureQuickVpp)).scale
 
-        if((state_bin & 0x8 ) == 8):
-            print ("Clipping occurs")      
-        elif((state_bin & 0x8 ) == 0):
-            print ("Clipping no occurs")    
-        
+        if mode == 'STAT':
 
-    #####################################################################
-    # Get clipping status of digital voltmeter
-    #####################################################################    
-    def getVoltmeterStatusClipping(self, session):
+            await self._call(self.scope._setupStatistics, self.session, channel, count)
 
-        state_bin = int(self.getVoltmeterStatus(session))
+            # Single acquisition is restored also after timeout or cancel
+            try:
+                await self.waitOperation('RUNS', 120)
+            finally:
+                await self._write('ACQ:NSIN:COUN 1')
 
-        if((state_bin & 0x8 ) == 8):
-            return 1    
-        elif((state_bin & 0x8 ) == 0):
-            return 0
+            vpp = await self._call(self.scope._readStatisticVpp, self.session, count)
 
+            if vpp is not None:
+                return vpp
 
-    #####################################################################
-    # Get voltmeter measured value
-    #####################################################################
-    def getVoltmeterValue(self, session, channel):
+            log.info("Statistics result is clipped, using host-side search")
 
-        clipping = self.getVoltmeterStatusClipping(session)
+        return await self._getHostVpp(channel, voltage, count)
 
-        set_voltage = 0.5
 
-        while clipping == 1:
+    async def _getHostVpp(self, channel, voltage, count):
 
-            set_voltage = set_voltage + 0.5
+        search = self.scope._startHostVpp(count)
 
-            self.setVertical(session, channel, set_voltage)
+        while search['i'] < count:
 
-            clipping = self.getVoltmeterStatusClipping(session)
+            await self.acquireSingle()
 
-            if(set_voltage > 50):
-                exit
-        
-        time.sleep(3)
+            if self.scope._hostVppStep(search, await self._query('MEAS:ARES?')):
+                ranger = await self.autorangeVertical(channel, voltage, self._measureQuickVpp)
+                voltage = self.scope._hostVppRanged(search, ranger)
 
-        voltage = session.query('DVM:RES?')
-        
-        voltage = voltage.replace('b\'','').replace('\\n','').replace('\'','')
-        
-        voltage = round(float(voltage),3)
+        return search['result']
 
-        return voltage
-        
 
     #####################################################################
-    # Print measured value
+    # Get VULpe value (see oscillograph.getVoltageDC)
     #####################################################################
-    def printVoltmeterValue(self, session, channel):
+    async def getVoltageDC(self, channel, bandwidth, htime, voltage, reset=True, timeout=None):
 
-        print(self.getVoltmeterValue(session, channel))
+        return await self._run(timeout, self._getVoltageDC, channel, bandwidth, htime, voltage, reset)
 
 
+    async def _getVoltageDC(self, channel, bandwidth, htime, voltage, reset):
+
+        await self._call(self.scope.setupQuickMeas, self.session, channel, 'DC', bandwidth, htime, voltage, reset)
+
+        await self._call(self.scope.setTriggerFindLevel, self.session)
+        await self.waitOperation()
+
+        await self.autorangeVertical(channel, voltage, self._measureQuickPeaks)
+
+        return await self._call(self.scope.getQuickMeasVULpe, self.session)
 
-    ########################################################################################
-    #                                                                                      #
-    #               Fuction to work with measure sequence                                  #
-    #                                                                                      #
-    ########################################################################################
 
     #####################################################################
-    # Set single shot or continous mode measure
+    # Get screenshot from device (see oscillograph.getScreenshot)
     #####################################################################
-    def setAcqState(self, session, state):
+    async def getScreenshot(self, screen_name, timeout=None):
 
-        if(state == "RUN"):
-            nstate = 'RUNC'
-        elif(state == "SINGLE"):
-            nstate = 'RUNS'
+        await self._run(timeout, self._getScreenshot, screen_name)
 
-        session.write(nstate)
 
+    async def _getScreenshot(self, screen_name):
 
-    ########################################################################################
-    #                                                                                      #
-    #               Fuction to work with quick measure sequence                            #
-    #                                                                                      #
-    ########################################################################################
+        await self._write("MMEM:CDIR '/USB_FRONT/'")
+        await self._write("MMEM:DEL 'SCREEN.png'")
 
-    #####################################################################
-    # On/off quick measure mode 
-    #####################################################################
-    def setQuickMeasState(self, session, state):
+        await self.waitOperation()
+        await self._call(self.scope.clearStatus, self.session)
 
-        if(state == 1):
-            state = 'MEAS:AON'
-        else:
-            state = 'MEAS:AOFF'
+        await self._write("HCOP:LANG PNG;:MMEM:NAME 'SCREEN'")
+        await self.waitOperation('HCOP:IMM')
 
-        session.write(state)
+        img = await self._call(self.scope._readScreenFile, self.session)
 
-    #####################################################################
-    # Get quick measure Vpp value
-    #####################################################################
-    def getQuickMeasVpp(self, session):
+        with open(screen_name, 'wb') as target:
+            target.write(img)
 
-        result = session.query('MEAS:ARES?')
-        result_arr = result.split(',')
-        result_alg = float(result_arr[0])
+        log.info("Getting screenshot from device: %s", screen_name)
 
-        return round(result_alg*1000, 1)
 
-    
-    #####################################################################
-    # Get VULpe value
-    #####################################################################
-    def getQuickMeasVULpe(self, session):
 
-        result_ul = []
+############################################################
+#  Command line batch runner
+#  Job file (JSON) - every measurement runs on every
+#  instrument:
+#
+#    {
+#      "instruments": ["192.168.1.106", "192.168.1.107"],
+#      "measurements": [
+#        {"name": "3V3", "method": "getVoltage", "args": [1]},
+#        {"name": "ripple", "method": "getVoltagePP",
+#         "args": [1, "20", 0.001], "kwargs": {"mode": "STAT"}}
+#      ]
+#    }
+#
+#  Instruments run in parallel (--workers), measurements of one
+#  instrument run in order. Every result is written as one
+#  JSON line as soon as it is finished:
+#
+#    python3 rtb2002.py jobs.json --workers 8 > results.jsonl
+#    python3 rtb2002.py jobs.json --dry-run
+############################################################
 
-        result = session.query('MEAS:ARES?')
+#####################################################################
+# Convert results (NumPy arrays, records) to strict JSON values
+# Non-finite floats (NaN, inf) become null
+#####################################################################
+def _jsonValue(value):
 
-        result_arr = result.split(',')
-        result_upe = float(result_arr[1])
-        result_lpe = float(result_arr[2])
+    if value is None or isinstance(value, (bool, int, str)):
+        return value
 
-        result_ul.append(round(result_upe, 1))
-        result_ul.append(round(result_lpe, 1))
+    if isinstance(value, float):
+        return value if np.isfinite(value) else None
 
-        return result_ul
+    if isinstance(value, dict):
+        return {str(key): _jsonValue(item) for key, item in value.items()}
 
+    if isinstance(value, (list, tuple)):
+        return [_jsonValue(item) for item in value]
 
-    ########################################################################################
-    #                                                                                      #
-    #               Function uses to get measured values                                   #
-    #                                                                                      #
-    ########################################################################################
+    if isinstance(value, (np.ndarray, np.generic)):
+        return _jsonValue(value.tolist())
 
+    if isinstance(value, quickMeas):
+        return {name: _jsonValue(getattr(value, name)) for name in value.__slots__}
 
-    #####################################################################
-    # Get voltage function
-    #####################################################################
-    def getVoltage(self, session, channel):
+    if isinstance(value, Exception):
+        return str(value)
 
-        self.resetDevice(session)
+    if hasattr(value, 'results'):
+        return _jsonValue(value.results())
 
-        self.setChannelState(session, channel, 1)
-        self.setChannelCoupling(session, channel, 'DC')
+    return str(value)
 
-        self.setVoltmeterState(session, 1)
-        self.setVoltmeterParam(session, 1, 'DC')
 
-        return round(self.getVoltmeterValue(session, channel), 1)
+#####################################################################
+# Read and check job file
+# Returns tuple (instruments, measurements)
+#####################################################################
+def _loadJobs(file_name):
 
-    
-    #####################################################################
-    # Get voltage Peak-to-peak 
-    #####################################################################
-    def getVoltagePP(self, session, channel, bandwidth, htime):
+    with open(file_name) as source:
+        jobs = json.load(source)
 
-        voltage = 0.010
+    instruments = jobs.get('instruments', [])
+    measurements = jobs.get('measurements', [])
 
-        self.resetDevice(session)
+    if not instruments or not measurements:
+        raise ValueError("Job file needs 'instruments' and 'measurements'")
 
-        self.setChannelState(session, channel, 1)
-        self.setChannelCoupling(session, channel, 'AC')
+    for measurement in measurements:
 
-        self.setVertical(session, channel, voltage)
-        self.setHorizontal(session, htime)
-        self.setBandwidth(session, channel, bandwidth)
-        self.setQuickMeasState(session, 1)
+        method = measurement.get('method', '')
 
-        time.sleep(10)
+        if method.startswith('_') or not callable(getattr(oscillograph, method, None)):
+            raise ValueError("Unknown measurement method: "+str(method))
 
-        self.setTriggerFindLevel(session)
+    return instruments, measurements
 
-        print("INFO: Searching maximum Vpp in 50 cycles...")
 
-        i = 1
-        vpp_result = 0
-        vpp_clipping = 0
+#####################################################################
+# Run all measurements on one instrument
+# - emit - function which writes one result
+#####################################################################
+def _runInstrument(pool, address, resource, measurements, emit):
 
-        while i < 50:
+    for measurement in measurements:
 
-            self.setAcqState(session, "SINGLE")
+        record = {
+            'address': address,
+            'name': measurement.get('name', measurement['method']),
+            'method': measurement['method'],
+            'result': None,
+            'error': None,
+            'start': time.time(),
+        }
 
-            time.sleep(1)
+        start = time.perf_counter()
 
-            vpp = self.getQuickMeasVpp(session)
+        try:
+            record['result'] = pool.run(resource, measurement['method'], *measurement.get('args', []), **measurement.get('kwargs', {}))
+        except Exception as e:
+            log.error("%s %s: %s", address, record['name'], e)
+            record['error'] = str(e) or type(e).__name__
 
-            print("DEBUG: VPP = "+str(vpp))
+        record['elapsed'] = time.perf_counter() - start
 
-            if (vpp == 9.91e+40) | (vpp < 0) :
-                print("DEBUG: (vpp == 9.91e+40) | (vpp < 0) ")
+        emit(record)
 
-                vpp_clipping = vpp_clipping + 1 
-                print("DEBUG: VPP Clipping counter:"+str(vpp_clipping))
 
-                if(vpp_clipping > 10):
+#####################################################################
+# Command line entry point
+# Returns exit code (0 - all measurements succeeded)
+#####################################################################
+def main(argv=None):
 
-                    print("DEBUG: VPP Clipping counter > 10 ")
+    parser = argparse.ArgumentParser(description="Run measurements of job file on Rohde&Schwarz RTB2002 oscilloscopes")
+    parser.add_argument('job_file', help="job file (JSON) with 'instruments' and 'measurements'")
+    parser.add_argument('-w', '--workers', type=int, default=8, help="instruments measured in parallel (default 8)")
+    parser.add_argument('-t', '--transport', default='INSTR', choices=('INSTR', 'SOCKET', 'HISLIP'), help="VISA transport (default INSTR)")
+    parser.add_argument('-o', '--output', help="JSON Lines file (default stdout)")
+    parser.add_argument('-n', '--dry-run', action='store_true', help="measure simulated instruments instead of real ones")
+    parser.add_argument('-v', '--verbose', action='count', default=0, help="log INFO (-v) or DEBUG (-vv) to stderr")
 
-                    if voltage == 0.010:
-                        voltage = 0.020
-                    elif voltage == 0.020:
-                        voltage = 0.050
-                    elif voltage == 0.050:
-                        voltage = 0.1
-                    elif voltage == 0.1:
-                        voltage = 0.2
-                    elif voltage == 0.2:
-                        voltage = 0.5
-                    elif voltage == 0.5:
-                        voltage = 1
-                    elif voltage == 1:
-                        voltage = 2
-                    elif voltage == 2:
-                        voltage = 5
-                    elif voltage == 5:
-                        voltage = 10
-                    elif voltage == 10:
-                        voltage = 20
-                    elif voltage == 20:
-                        print("ERROR: Maximum voltage, error...")
-                        exit()
+    args = parser.parse_args(argv)
 
-                    self.setVertical(session, channel, voltage)
-                    vpp_clipping = 0
+    logging.basicConfig(level=(logging.WARNING, logging.INFO, logging.DEBUG)[min(args.verbose, 2)], stream=sys.stderr)
 
-                    print("VPP cliping counter overloaded ")
-                    print("INFO/ERROR: set new voltage scale to oscilloscope: "+str(voltage))
-                    i = 0
-                
-                vpp = 0
+    try:
+        instruments, measurements = _loadJobs(args.job_file)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
 
-            if vpp > vpp_result:
-                vpp_result = vpp
-            
-            i = i + 1
+    output = open(args.output, 'a') if args.output else sys.stdout
+    output_lock = threading.Lock()
+    failures = []
 
-        return vpp_result
+    def emit(record):
+        with output_lock:
+            if record['error'] is not None:
+                failures.append(record)
+            output.write(json.dumps(_jsonValue(record), allow_nan=False)+'\n')
+            output.flush()
 
-    
-    #####################################################################
-    # Fucntion to get VULpe value 
-    #####################################################################
-    def getVoltageDC(self, session, channel, bandwidth, htime, voltage):
+    simulators = []
+    resources = {address: address for address in instruments}
+    transport = args.transport
+    visa_library = None
 
-        self.resetDevice(session)
+    if args.dry_run:
 
-        self.setChannelState(session, channel, 1)
-        self.setChannelCoupling(session, channel, 'DC')
+        from rtb2002_sim import simulator
 
-        self.setVertical(session, channel, voltage)
-        self.setHorizontal(session, htime)
-        self.setBandwidth(session, channel, bandwidth)
-        self.setQuickMeasState(session, 1)
+        # Simulators listen on raw sockets only
+        transport = 'SOCKET'
+        visa_library = '@py'
 
-        time.sleep(10)
-        self.setTriggerFindLevel(session)
-        
-        return self.getQuickMeasVULpe(session)
+        for address in instruments:
+            simulators.append(simulator())
+            resources[address] = resourceName('127.0.0.1', 'SOCKET', simulators[-1].start())
+
+    try:
+        # Rejected setup is failure of measurement, not only logged
+        with oscillographPool(args.workers, transport, visa_library, raise_batch_errors=True) as pool:
+            with ThreadPoolExecutor(max_workers=args.workers) as executor:
+                for address in instruments:
+                    executor.submit(_runInstrument, pool, address, resources[address], measurements, emit)
+
+    finally:
+        for sim in simulators:
+            sim.stop()
+
+        if output is not sys.stdout:
+            output.close()
+
+    return 1 if failures else 0
 
 
+if __name__ == '__main__':
 
+    sys.exit(main())
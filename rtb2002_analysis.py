@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+
+import functools
+
+import numpy as np
+
+
+############################################################
+#  Host-side analysis of waveforms captured with
+#  oscillograph (getWaveform, captureChannels,
+#  captureSegments, pipelineAcquisitions):
+#
+#    xtime, times, volts = scope.captureSegments(session, 1, 100)
+#    upper, lower = envelopeMask(volts[0], 0.05)
+#    result = maskTest(volts, upper, lower)
+############################################################
+
+
+############################################################
+#  Mask from reference waveform
+#  - reference - waveform in V (1-D array)
+#  - tolerance - allowed deviation in V (scalar or array)
+#  - relative - allowed deviation as part of |reference|
+#  Returns tuple (upper, lower) of 1-D arrays
+############################################################
+def envelopeMask(reference, tolerance, relative=0.0):
+
+    reference = np.asarray(reference, dtype=np.float64)
+    band = tolerance + relative * np.abs(reference)
+
+    return reference + band, reference - band
+
+
+############################################################
+#  Mask defined by corner points on time axis of record
+#  - xtime - time axis of record in s
+#  - mask_time, mask_values - corner points of mask (time
+#                             in s, increasing)
+#  Returns 1-D array of mask values at every sample
+############################################################
+def interpolateMask(xtime, mask_time, mask_values):
+
+    return np.interp(xtime, mask_time, mask_values)
+
+
+############################################################
+#  Mask test of batch of waveforms in one pass
+#  - volts - waveforms in V, one per row (2-D array)
+#  - upper, lower - envelope in V, scalar or 1-D array with
+#                   one value per sample (None - no limit)
+#  Returns dict of 1-D arrays (one value per waveform):
+#  - passed - True if all samples are inside mask
+#  - violations - number of samples outside mask
+#  - first - index of first sample outside mask (-1 if passed)
+#  - margin - worst distance to mask in V (negative if outside)
+#  - worst - index of sample with worst margin
+############################################################
+def maskTest(volts, upper=None, lower=None):
+
+    volts = np.atleast_2d(volts)
+
+    if upper is None and lower is None:
+        raise ValueError("Mask needs upper or lower limit")
+
+    # Distance to nearest limit in one buffer of batch size:
+    # min(upper - v, v - lower) = half - |upper - v - half|,
+    # half = (upper - lower) / 2 has size of one waveform
+    if upper is not None:
+        margin = np.subtract(upper, volts, dtype=np.float64)
+        if lower is not None:
+            half = (np.asarray(upper, dtype=np.float64) - lower) / 2
+            margin -= half
+            np.abs(margin, out=margin)
+            np.subtract(half, margin, out=margin)
+    else:
+        margin = np.subtract(volts, lower, dtype=np.float64)
+
+    outside = margin < 0
+
+    violations = outside.sum(axis=1)
+    worst = margin.argmin(axis=1)
+
+    return {
+        'passed': violations == 0,
+        'violations': violations,
+        'first': np.where(violations > 0, outside.argmax(axis=1), -1),
+        'margin': np.take_along_axis(margin, worst[:, None], axis=1)[:, 0],
+        'worst': worst,
+    }
+
+
+############################################################
+#  Limit test of measurements of batch of waveforms
+#  - stats - dict of 1-D arrays, e.g. waveformStats() result
+#  - limits - {name: (low, high)}, None - no limit
+#  Returns dict:
+#  - passed - 1-D bool array, all limits are kept
+#  - failed - {name: 1-D bool array}
+#  - margin - {name: 1-D array of distance to nearest limit,
+#              negative if limit is violated}
+############################################################
+def limitTest(stats, limits):
+
+    passed = None
+    failed = {}
+    margins = {}
+
+    for name, (low, high) in limits.items():
+
+        values = np.asarray(stats[name], dtype=np.float64)
+        margin = np.full(values.shape, np.inf)
+
+        if high is not None:
+            np.minimum(margin, high - values, out=margin)
+
+        if low is not None:
+            np.minimum(margin, values - low, out=margin)
+
+        # NaN result (e.g. no frequency found) fails limit
+        failed[name] = ~(margin >= 0)
+        margins[name] = margin
+
+        passed = ~failed[name] if passed is None else passed & ~failed[name]
+
+    return {
+        'passed': passed,
+        'failed': failed,
+        'margin': margins,
+    }
+
+
+############################################################
+#  Sample step of time axis in s
+############################################################
+def _step(xtime):
+
+    return (xtime[-1] - xtime[0]) / (len(xtime) - 1)
+
+
+############################################################
+#  FFT window of record length (cached, read only)
+#  - name - 'hann', 'hamming', 'blackman', 'flattop' or 'rect'
+############################################################
+@functools.lru_cache(maxsize=32)
+def window(name, points):
+
+    if name == 'hann':
+        values = np.hanning(points)
+    elif name == 'hamming':
+        values = np.hamming(points)
+    elif name == 'blackman':
+        values = np.blackman(points)
+    elif name == 'flattop':
+        phase = 2 * np.pi * np.arange(points) / (points - 1)
+        values = (0.21557895 - 0.41663158 * np.cos(phase) + 0.277263158 * np.cos(2 * phase)
+                  - 0.083578947 * np.cos(3 * phase) + 0.006947368 * np.cos(4 * phase))
+    elif name == 'rect':
+        values = np.ones(points)
+    else:
+        raise ValueError("Unknown window: "+name)
+
+    values.flags.writeable = False
+
+    return values
+
+
+############################################################
+#  Frequency axis of one-sided FFT (cached, read only)
+############################################################
+@functools.lru_cache(maxsize=32)
+def _frequencies(points, step):
+
+    values = np.fft.rfftfreq(points, step)
+    values.flags.writeable = False
+
+    return values
+
+
+############################################################
+#  Power spectral density of batch of waveforms
+#  - xtime - time axis in s (1-D array)
+#  - volts - waveforms in V, one per row (2-D array)
+#  - window_name - FFT window name (see window)
+#  - detrend - remove mean of every waveform before FFT
+#  Returns tuple (frequency axis in Hz, one-sided PSD in
+#  V^2/Hz with one row per waveform)
+############################################################
+def psd(xtime, volts, window_name='hann', detrend=True):
+
+    volts = np.atleast_2d(volts)
+    points = volts.shape[1]
+    step = _step(xtime)
+
+    weights = window(window_name, points)
+
+    if detrend:
+        data = volts - volts.mean(axis=1, keepdims=True)
+        data *= weights
+    else:
+        data = volts * weights
+
+    spectrum = np.fft.rfft(data, axis=1)
+
+    power = spectrum.real ** 2
+    power += spectrum.imag ** 2
+    power *= step / np.dot(weights, weights)
+
+    # One-sided: double all bins except DC and Nyquist
+    power[:, 1:(points + 1) // 2] *= 2
+
+    return _frequencies(points, step), power
+
+
+############################################################
+#  RMS of every waveform within frequency bands
+#  - freq, power - result of psd()
+#  - bands - list of (low, high) in Hz, high inclusive
+#  Returns 2-D array (one row per waveform, one column per
+#  band) of RMS in V
+############################################################
+def bandRMS(freq, power, bands):
+
+    resolution = freq[1] - freq[0]
+
+    # Cumulative power makes every band one subtraction
+    total = np.zeros((power.shape[0], power.shape[1] + 1))
+    np.cumsum(power, axis=1, out=total[:, 1:])
+
+    result = np.empty((power.shape[0], len(bands)))
+
+    for column, (low, high) in enumerate(bands):
+        start = np.searchsorted(freq, low, side='left')
+        stop = np.searchsorted(freq, high, side='right')
+        result[:, column] = total[:, stop] - total[:, start]
+
+    return np.sqrt(np.maximum(result, 0) * resolution)
+
+
+############################################################
+#  Dominant frequency of every waveform
+#  - freq, power - result of psd()
+#  - fmin - ignore lower frequencies (Hz)
+#  Returns 1-D array of frequencies in Hz (interpolated
+#  between bins)
+############################################################
+def dominantFrequency(freq, power, fmin=0.0):
+
+    start = max(int(np.searchsorted(freq, fmin, side='right')), 1)
+
+    peak = power[:, start:].argmax(axis=1) + start
+
+    # Parabolic interpolation of log power around peak bin
+    left = np.log(power[np.arange(len(peak)), np.maximum(peak - 1, 0)] + 1e-300)
+    center = np.log(power[np.arange(len(peak)), peak] + 1e-300)
+    right = np.log(power[np.arange(len(peak)), np.minimum(peak + 1, power.shape[1] - 1)] + 1e-300)
+
+    denominator = left - 2 * center + right
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.where(denominator < 0, 0.5 * (left - right) / denominator, 0.0)
+
+    return freq[peak] + np.clip(offset, -0.5, 0.5) * (freq[1] - freq[0])
+
+
+############################################################
+#  Magnitude response of Butterworth low-pass (cached)
+############################################################
+@functools.lru_cache(maxsize=32)
+def _lowPassResponse(points, step, cutoff, order):
+
+    response = 1 / np.sqrt(1 + (_frequencies(points, step) / cutoff) ** (2 * order))
+    response.flags.writeable = False
+
+    return response
+
+
+############################################################
+#  Software bandwidth limit (zero phase, in frequency domain)
+#  - cutoff - -3 dB frequency in Hz (20e6 - like B20 limit
+#             of oscilloscope)
+#  - order - order of Butterworth magnitude response
+#  Returns filtered waveforms (2-D array)
+############################################################
+def lowPass(xtime, volts, cutoff=20e6, order=2):
+
+    volts = np.atleast_2d(volts)
+    points = volts.shape[1]
+
+    spectrum = np.fft.rfft(volts, axis=1)
+    spectrum *= _lowPassResponse(points, _step(xtime), float(cutoff), order)
+
+    return np.fft.irfft(spectrum, points, axis=1)
+
+
+############################################################
+#  Ripple of batch of waveforms from one acquisition
+#  - bandwidth - software bandwidth limit in Hz (None - off)
+#  - bands - list of (low, high) in Hz for band RMS
+#  Returns dict of arrays (one value per waveform):
+#  vpp, rms (AC), frequency (dominant), bands (2-D, one
+#  column per band, if bands are given), and freq/psd
+############################################################
+def rippleAnalysis(xtime, volts, bandwidth=20e6, bands=None, window_name='hann', fmin=0.0):
+
+    volts = np.atleast_2d(volts)
+
+    if bandwidth is not None:
+        volts = lowPass(xtime, volts, bandwidth)
+
+    freq, power = psd(xtime, volts, window_name)
+
+    result = {
+        'vpp': volts.max(axis=1) - volts.min(axis=1),
+        'rms': volts.std(axis=1),
+        'frequency': dominantFrequency(freq, power, fmin),
+        'freq': freq,
+        'psd': power,
+    }
+
+    if bands:
+        result['bands'] = bandRMS(freq, power, bands)
+
+    return result
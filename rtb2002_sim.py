@@ -0,0 +1,806 @@
+#!/usr/bin/env python3
+
+import json
+import re
+import socketserver
+import sys
+import threading
+import time
+
+import numpy as np
+
+
+############################################################
+#  Find end of SCPI message (LF outside of strings and
+#  binary blocks)
+#  Returns (message, rest of buffer) or (None, buffer) if
+#  message is not complete yet
+############################################################
+def _nextMessage(buf):
+
+    i = 0
+    quote = None
+
+    while i < len(buf):
+
+        char = buf[i:i+1]
+
+        if quote is not None:
+            if char == quote:
+                quote = None
+
+        elif char in (b'"', b"'"):
+            quote = char
+
+        elif char == b'#' and buf[i+1:i+2].isdigit() and buf[i+1:i+2] != b'0':
+
+            digits = int(buf[i+1:i+2])
+
+            if len(buf) < i + 2 + digits:
+                return None, buf
+
+            i = i + 2 + digits + int(buf[i+2:i+2+digits])
+            continue
+
+        elif char == b'\n':
+            return buf[:i], buf[i+1:]
+
+        i = i + 1
+
+    return None, buf
+
+
+############################################################
+#  Split SCPI message into program units (';' outside of
+#  strings and binary blocks)
+############################################################
+def _splitUnits(message):
+
+    units = []
+    start = 0
+    i = 0
+    quote = None
+
+    while i < len(message):
+
+        char = message[i:i+1]
+
+        if quote is not None:
+            if char == quote:
+                quote = None
+
+        elif char in (b'"', b"'"):
+            quote = char
+
+        elif char == b'#' and message[i+1:i+2].isdigit() and message[i+1:i+2] != b'0':
+
+            digits = int(message[i+1:i+2])
+            i = i + 2 + digits + int(message[i+2:i+2+digits])
+            continue
+
+        elif char == b';':
+            units.append(message[start:i])
+            start = i + 1
+
+        i = i + 1
+
+    units.append(message[start:])
+
+    return [unit.strip() for unit in units if unit.strip()]
+
+
+############################################################
+#  IEEE-488.2 definite length block
+############################################################
+def _block(data):
+
+    length = str(len(data)).encode()
+
+    return b'#' + str(len(length)).encode() + length + data
+
+
+############################################################
+#  Simulated Rhode&Schwarz RTB2002 with raw SCPI socket
+#  Models status/OPC handling, voltmeter, quick measure,
+#  measurement statistics, waveform data, screenshots and
+#  clipping at +/-5 divisions. Accepts short form headers as
+#  used by rtb2002.py:
+#
+#    with simulator() as sim:
+#        session = scope.connect('127.0.0.1', 'SOCKET', sim.port)
+############################################################
+class simulator(object):
+
+    IDN = 'Rohde&Schwarz,RTB2002,1333.1005k02/102030,02.400'
+
+    # Settings which are stored as written and returned on query
+    SETTINGS = re.compile(r'^(CHAN[1-4]:(SCAL|BAND|COUP|STAT|OFFS|DATA:POIN)|TIM:(SCAL|POS)|'
+                          r'TRIG:A:(SOUR|LEV)|DVM:(ENAB|SOUR|TYPE)|FORM|FORM:BORD|'
+                          r'MEAS[1-8]:(SOUR|MAIN|ENAB|STAT|STAT:WEIG)|ACQ:NSIN:COUN|ACQ:SEGM:STAT|'
+                          r'HCOP:LANG|MMEM:NAME|MMEM:CDIR|\*ESE|\*SRE)$')
+
+    # Values of settings after *RST
+    DEFAULTS = {
+        'TIM:SCAL': '0.0001',
+        'TRIG:A:SOUR': 'CH1',
+        'TRIG:A:LEV': '0',
+        'DVM:ENAB': 'OFF',
+        'DVM:SOUR': 'CH1',
+        'DVM:TYPE': 'DC',
+        'FORM': 'ASC',
+        'FORM:BORD': 'LSBF',
+        'ACQ:NSIN:COUN': '1',
+        'ACQ:SEGM:STAT': 'OFF',
+        'HCOP:LANG': 'PNG',
+        'MMEM:NAME': 'SCREEN',
+        'MMEM:CDIR': '/INT/',
+        '*ESE': '0',
+        '*SRE': '0',
+    }
+
+    #####################################################################
+    # Signals:
+    # - {channel: {'dc': V, 'vpp': V, 'frequency': Hz, 'noise': V}}
+    # Delay:
+    # - processing delay of every query in s
+    # Acquisition_time:
+    # - duration of one single acquisition in s
+    #####################################################################
+    def __init__(self, signals=None, delay=0.0, acquisition_time=0.02, points=10000, screenshot_size=40000, seed=0):
+
+        if signals is None:
+            signals = {
+                1: {'dc': 3.3, 'vpp': 0.045, 'frequency': 100e3, 'noise': 0.002},
+                2: {'dc': 12.0, 'vpp': 0.3, 'frequency': 250e3, 'noise': 0.01},
+            }
+
+        self.signals = signals
+        self.delay = delay
+        self.acquisition_time = acquisition_time
+        self.points = points
+        self.screenshot_size = screenshot_size
+
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        self.server = None
+
+        self.resetCounters()
+        self.reset()
+
+
+    def __enter__(self):
+
+        self.start()
+        return self
+
+
+    def __exit__(self, *exc):
+
+        self.stop()
+
+
+    #####################################################################
+    # Reset instrument state (*RST)
+    #####################################################################
+    def reset(self):
+
+        self.settings = dict(self.DEFAULTS)
+
+        for channel in range(1, 5):
+            self.settings['CHAN'+str(channel)+':SCAL'] = '0.5'
+            self.settings['CHAN'+str(channel)+':BAND'] = 'FULL'
+            self.settings['CHAN'+str(channel)+':COUP'] = 'DCL'
+            self.settings['CHAN'+str(channel)+':STAT'] = 'ON' if channel == 1 else 'OFF'
+            self.settings['CHAN'+str(channel)+':OFFS'] = '0'
+            self.settings['CHAN'+str(channel)+':DATA:POIN'] = 'DEF'
+
+        self.errors = []
+        self.esr = 0
+        self.opc_pending = False
+        self.busy_until = 0.0
+
+        self.running = True
+        self.quick_meas = False
+        self.active = 1
+        self.records = {}
+        self.stat_values = []
+
+        # Segmented memory: [(trigger time, records)], newest last
+        self.history = []
+        self.history_index = 0
+
+        self.files = getattr(self, 'files', {})
+        self.slots = getattr(self, 'slots', {})
+
+
+    #####################################################################
+    # Reset traffic counters
+    #####################################################################
+    def resetCounters(self):
+
+        self.counters = {'messages': 0, 'round_trips': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+
+    #####################################################################
+    # Start server in background thread
+    # Returns TCP port
+    #####################################################################
+    def start(self, host='127.0.0.1', port=0):
+
+        sim = self
+
+        class handler(socketserver.BaseRequestHandler):
+
+            def handle(self):
+
+                buf = b''
+
+                while True:
+
+                    data = self.request.recv(65536)
+
+                    if not data:
+                        break
+
+                    buf = buf + data
+
+                    while True:
+
+                        message, buf = _nextMessage(buf)
+
+                        if message is None:
+                            break
+
+                        response = sim.process(message)
+
+                        if response is not None:
+                            self.request.sendall(response)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+
+        self.server = socketserver.ThreadingTCPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.host, self.port = self.server.server_address
+
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        return self.port
+
+
+    #####################################################################
+    # Stop server
+    #####################################################################
+    def stop(self):
+
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+    #####################################################################
+    # VISA resource string of running simulator
+    #####################################################################
+    @property
+    def resource(self):
+
+        return 'TCPIP::'+self.host+'::'+str(self.port)+'::SOCKET'
+
+
+    #####################################################################
+    # Process one SCPI message
+    # Returns response bytes or None if message has no queries
+    #####################################################################
+    def process(self, message):
+
+        responses = []
+        wait = 0.0
+
+        with self.lock:
+
+            self.counters['messages'] = self.counters['messages'] + 1
+            self.counters['bytes_in'] = self.counters['bytes_in'] + len(message) + 1
+
+            for unit in _splitUnits(message):
+
+                header, _, argument = unit.partition(b' ')
+                header = header.decode('latin-1').lstrip(':').upper()
+
+                try:
+                    answer = self._execute(header, argument.strip())
+                except Exception as e:
+                    self.errors.append('-113,"Undefined header;'+header+'"' if isinstance(e, KeyError) else '-224,"Illegal parameter value;'+str(e)+'"')
+                    self.esr = self.esr | 0x20
+                    answer = None
+
+                # *OPC? blocks until pending operations are complete
+                if header == '*OPC?':
+                    wait = max(wait, self.busy_until - time.perf_counter())
+
+                if answer is not None:
+                    responses.append(answer if isinstance(answer, bytes) else str(answer).encode())
+
+            if not responses:
+                return None
+
+            response = b';'.join(responses) + b'\n'
+
+            self.counters['round_trips'] = self.counters['round_trips'] + 1
+            self.counters['bytes_out'] = self.counters['bytes_out'] + len(response)
+
+        time.sleep(max(wait, 0.0) + self.delay)
+
+        return response
+
+
+    #####################################################################
+    # Execute program unit, returns answer of query or None
+    #####################################################################
+    def _execute(self, header, argument):
+
+        match = re.match(r'^CHAN([1-4]):', header)
+
+        if match:
+            self.active = int(match.group(1))
+
+        name = header.rstrip('?')
+        query = header.endswith('?')
+
+        handler = self.HANDLERS.get(name)
+
+        if handler is None:
+            for pattern, func in self.PATTERN_HANDLERS:
+                match = pattern.match(name)
+                if match:
+                    return func(self, int(match.group(1)), query, argument)
+
+        if handler is not None:
+            return handler(self, query, argument)
+
+        if self.SETTINGS.match(name):
+
+            if query:
+                return self.settings.get(name, '0')
+
+            self.settings[name] = argument.decode('latin-1').strip("'\"")
+            return None
+
+        raise KeyError(header)
+
+
+    #####################################################################
+    # Common commands
+    #####################################################################
+    def _idn(self, query, argument):
+
+        return self.IDN
+
+
+    def _rst(self, query, argument):
+
+        self.reset()
+
+
+    def _cls(self, query, argument):
+
+        self.errors = []
+        self.esr = 0
+        self.opc_pending = False
+
+
+    def _opc(self, query, argument):
+
+        if query:
+            return '1'
+
+        self.opc_pending = True
+
+
+    def _esr(self, query, argument):
+
+        if self.opc_pending and time.perf_counter() >= self.busy_until:
+            self.esr = self.esr | 0x1
+            self.opc_pending = False
+
+        esr = self.esr
+        self.esr = 0
+
+        return str(esr)
+
+
+    def _stb(self, query, argument):
+
+        return str(0x4 if self.errors else 0)
+
+
+    def _systErr(self, query, argument):
+
+        if self.errors:
+            return self.errors.pop(0)
+
+        return '0,"No error"'
+
+
+    #####################################################################
+    # Acquisition
+    #####################################################################
+    def _busy(self, duration):
+
+        self.busy_until = max(self.busy_until, time.perf_counter()) + duration
+
+
+    def _runs(self, query, argument):
+
+        count = int(float(self.settings['ACQ:NSIN:COUN']))
+
+        self.history = []
+        self.history_index = 0
+
+        for i in range(count):
+            self._acquire()
+
+            if self.settings['ACQ:SEGM:STAT'] in ('ON', '1'):
+                self.history.append((i * self.acquisition_time, dict(self.records)))
+
+        self.running = False
+        self._busy(self.acquisition_time * count)
+
+
+    def _runc(self, query, argument):
+
+        self.running = True
+
+
+    def _stop(self, query, argument):
+
+        self.running = False
+
+
+    def _trigFind(self, query, argument):
+
+        signal = self.signals.get(self.active, {})
+        self.settings['TRIG:A:LEV'] = str(signal.get('dc', 0.0))
+        self._busy(0.05)
+
+
+    #####################################################################
+    # Synthesize records of all signal channels
+    #####################################################################
+    def _acquire(self):
+
+        tscale = float(self.settings['TIM:SCAL'])
+        xtime = np.linspace(-6 * tscale, 6 * tscale, self.points, endpoint=False)
+
+        for channel, signal in self.signals.items():
+
+            scale = float(self.settings['CHAN'+str(channel)+':SCAL'])
+
+            # Rare spikes make maximum search meaningful
+            vpp = signal.get('vpp', 0.0) * (1.5 if self.rng.random() < 0.05 else self.rng.uniform(0.9, 1.0))
+
+            volts = vpp / 2 * np.sin(2 * np.pi * signal.get('frequency', 1e3) * xtime + self.rng.uniform(0, 2 * np.pi))
+            volts = volts + self.rng.normal(0.0, signal.get('noise', 0.0), self.points)
+
+            if self.settings['CHAN'+str(channel)+':COUP'] != 'ACL':
+                volts = volts + signal.get('dc', 0.0)
+
+            limit = 5 * scale
+            clipped = bool(np.any(np.abs(volts) >= limit))
+
+            self.records[channel] = (np.clip(volts, -limit, limit * 127 / 128), clipped)
+
+        if self.settings.get('MEAS1:STAT') in ('ON', '1'):
+            # Record of this acquisition, _record would acquire again
+            source = int(self.settings.get('MEAS1:SOUR', 'CH1')[-1])
+            record = self.records.get(source, (np.zeros(self.points), False))
+            self.stat_values.append(self._quickMeas(source, record)[0])
+
+
+    #####################################################################
+    # Record of channel (new one while acquisition is running)
+    #####################################################################
+    def _record(self, channel):
+
+        if self.running or channel not in self.records:
+            self._acquire()
+
+        if channel not in self.records:
+            return np.zeros(self.points), False
+
+        return self.records[channel]
+
+
+    #####################################################################
+    # Quick measure results of channel
+    # - record - (volts, clipped), None - current record of channel
+    #####################################################################
+    def _quickMeas(self, channel, record=None):
+
+        volts, clipped = record if record is not None else self._record(channel)
+
+        if clipped:
+            return [9.91e+37] * 9
+
+        signal = self.signals.get(channel, {})
+        frequency = signal.get('frequency', 0.0) if signal.get('vpp', 0.0) > 0 else 9.91e+37
+        period = 1 / frequency if frequency < 9.91e+37 else 9.91e+37
+        vpp = float(volts.max() - volts.min())
+        rise = 0.33 * period if period < 9.91e+37 else 9.91e+37
+
+        return [vpp, float(volts.max()), float(volts.min()), frequency, period,
+                float(np.sqrt(np.mean(volts ** 2))), float(volts.mean()), rise, rise]
+
+
+    def _measAon(self, query, argument):
+
+        self.quick_meas = True
+
+
+    def _measAoff(self, query, argument):
+
+        self.quick_meas = False
+
+
+    def _measAres(self, query, argument):
+
+        return ','.join('{0:.6E}'.format(value) for value in self._quickMeas(self.active))
+
+
+    def _measStatRes(self, channel, query, argument):
+
+        self.stat_values = []
+
+
+    def _measResPpe(self, channel, query, argument):
+
+        if not self.stat_values:
+            return '9.91E+37'
+
+        return '{0:.6E}'.format(max(self.stat_values))
+
+
+    def _measResWfmc(self, channel, query, argument):
+
+        return str(len(self.stat_values))
+
+
+    #####################################################################
+    # Digital voltmeter
+    #####################################################################
+    def _dvmResult(self):
+
+        channel = int(self.settings['DVM:SOUR'][-1])
+        volts, clipped = self._record(channel)
+
+        dvm_type = self.settings['DVM:TYPE']
+
+        if dvm_type.startswith('ACRM'):
+            value = float(np.std(volts))
+        elif dvm_type.startswith('ACDC'):
+            value = float(np.sqrt(np.mean(volts ** 2)))
+        else:
+            value = float(volts.mean())
+
+        return value, clipped
+
+
+    def _dvmRes(self, query, argument):
+
+        value, clipped = self._dvmResult()
+
+        return '{0:.6E}'.format(9.91e+37 if clipped else value)
+
+
+    def _dvmResStat(self, query, argument):
+
+        value, clipped = self._dvmResult()
+
+        return '0,'+str(0x8 if clipped else 0x1)
+
+
+    #####################################################################
+    # Waveform data
+    #####################################################################
+    def _scaling(self, channel):
+
+        scale = float(self.settings['CHAN'+str(channel)+':SCAL'])
+        bits = 16 if self.settings['FORM'].startswith('UINT,16') else 8
+        yinc = 10 * scale / (1 << bits)
+
+        return -(1 << (bits - 1)) * yinc, yinc
+
+
+    def _dataHead(self, channel, query, argument):
+
+        tscale = float(self.settings['TIM:SCAL'])
+
+        return '{0:.6E},{1:.6E},{2},1'.format(-6 * tscale, 6 * tscale, self.points)
+
+
+    def _dataYor(self, channel, query, argument):
+
+        return '{0:.9E}'.format(self._scaling(channel)[0])
+
+
+    def _dataYinc(self, channel, query, argument):
+
+        return '{0:.9E}'.format(self._scaling(channel)[1])
+
+
+    def _data(self, channel, query, argument):
+
+        volts, clipped = self._record(channel)
+        data_format = self.settings['FORM']
+
+        if data_format.startswith('REAL'):
+            return _block(volts.astype('<f4').tobytes())
+
+        yor, yinc = self._scaling(channel)
+
+        if data_format.startswith('UINT,16'):
+            return _block(np.round((volts - yor) / yinc).astype('<u2').tobytes())
+
+        if data_format.startswith('UINT'):
+            return _block(np.round((volts - yor) / yinc).astype('u1').tobytes())
+
+        return ','.join('{0:.4E}'.format(value) for value in volts)
+
+
+    #####################################################################
+    # Segmented memory (history)
+    # Index 0 is newest acquisition, negative indexes are older ones
+    #####################################################################
+    def _acqAva(self, query, argument):
+
+        return str(len(self.history))
+
+
+    def _histCurr(self, channel, query, argument):
+
+        if query:
+            return str(self.history_index)
+
+        index = int(argument)
+
+        if not self.history or not -len(self.history) < index <= 0:
+            raise ValueError('history index '+str(index)+' out of range')
+
+        self.history_index = index
+        self.records = dict(self.history[len(self.history) - 1 + index][1])
+
+
+    def _histTsr(self, channel, query, argument):
+
+        if not self.history:
+            return '0'
+
+        return '{0:.9E}'.format(self.history[len(self.history) - 1 + self.history_index][0] - self.history[-1][0])
+
+
+    #####################################################################
+    # Screenshots and mass memory
+    #####################################################################
+    def _screenshot(self):
+
+        self._busy(0.2)
+
+        return b'\x89PNG\r\n\x1a\n' + self.rng.integers(0, 256, self.screenshot_size, dtype=np.uint8).tobytes()
+
+
+    def _hcopImm(self, query, argument):
+
+        name = self.settings['MMEM:CDIR'] + self.settings['MMEM:NAME'] + '.png'
+        self.files[name.upper()] = self._screenshot()
+
+
+    def _hcopData(self, query, argument):
+
+        return _block(self._screenshot())
+
+
+    def _fileName(self, argument):
+
+        return (self.settings['MMEM:CDIR'] + argument.decode('latin-1').strip("'\"")).upper()
+
+
+    def _mmemDel(self, query, argument):
+
+        if self.files.pop(self._fileName(argument), None) is None:
+            self.errors.append('-256,"File name not found"')
+
+
+    def _mmemData(self, query, argument):
+
+        data = self.files.get(self._fileName(argument))
+
+        if data is None:
+            self.errors.append('-256,"File name not found"')
+            return _block(b'')
+
+        return _block(data)
+
+
+    #####################################################################
+    # Instrument setups
+    #####################################################################
+    def _systSet(self, query, argument):
+
+        if query:
+            return _block(json.dumps(self.settings, sort_keys=True).encode())
+
+        digits = int(argument[1:2])
+        length = int(argument[2:2+digits])
+
+        self.settings = json.loads(argument[2+digits:2+digits+length].decode('latin-1'))
+
+
+    def _sav(self, query, argument):
+
+        self.slots[int(argument)] = dict(self.settings)
+
+
+    def _rcl(self, query, argument):
+
+        if int(argument) not in self.slots:
+            raise ValueError('setup slot '+argument.decode('latin-1')+' is empty')
+
+        self.settings = dict(self.slots[int(argument)])
+
+
+    HANDLERS = {
+        '*IDN': _idn,
+        '*RST': _rst,
+        '*CLS': _cls,
+        '*OPC': _opc,
+        '*ESR': _esr,
+        '*STB': _stb,
+        'SYST:ERR': _systErr,
+        'SYST:SET': _systSet,
+        '*SAV': _sav,
+        '*RCL': _rcl,
+        'RUNS': _runs,
+        'ACQ:AVA': _acqAva,
+        'SING': _runs,
+        'RUNC': _runc,
+        'RUN': _runc,
+        'STOP': _stop,
+        'TRIG:A:FIND': _trigFind,
+        'MEAS:AON': _measAon,
+        'MEAS:AOFF': _measAoff,
+        'MEAS:ARES': _measAres,
+        'DVM:RES': _dvmRes,
+        'DVM:RES:STAT': _dvmResStat,
+        'HCOP:IMM': _hcopImm,
+        'HCOP:DATA': _hcopData,
+        'MMEM:DEL': _mmemDel,
+        'MMEM:DATA': _mmemData,
+    }
+
+    PATTERN_HANDLERS = [
+        (re.compile(r'^CHAN([1-4]):DATA:HEAD$'), _dataHead),
+        (re.compile(r'^CHAN([1-4]):DATA:YOR$'), _dataYor),
+        (re.compile(r'^CHAN([1-4]):DATA:YINC$'), _dataYinc),
+        (re.compile(r'^CHAN([1-4]):DATA$'), _data),
+        (re.compile(r'^CHAN([1-4]):HIST:CURR$'), _histCurr),
+        (re.compile(r'^CHAN([1-4]):HIST:TSR$'), _histTsr),
+        (re.compile(r'^MEAS([1-8]):STAT:RES$'), _measStatRes),
+        (re.compile(r'^MEAS([1-8]):RES:PPE$'), _measResPpe),
+        (re.compile(r'^MEAS([1-8]):RES:WFMC$'), _measResWfmc),
+    ]
+
+
+
+if __name__ == '__main__':
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 5025
+
+    sim = simulator()
+    sim.start('0.0.0.0', port)
+
+    print("INFO: Simulated RTB2002 listening on port "+str(sim.port))
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()
@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+
+import json
+
+import numpy as np
+import pytest
+
+pyvisa = pytest.importorskip('pyvisa')
+pytest.importorskip('pyvisa_py')
+
+import rtb2002
+import rtb2002_analysis
+from rtb2002 import autorange, oscillograph, quickMeas
+from rtb2002_sim import simulator
+
+
+############################################################
+#  Regression tests of rtb2002.py on simulated oscilloscope
+#  (rtb2002_sim), run with: python3 -m pytest -q
+############################################################
+
+
+@pytest.fixture
+def sim():
+
+    with simulator() as instrument:
+        yield instrument
+
+
+@pytest.fixture
+def scope(sim):
+
+    rm = pyvisa.ResourceManager('@py')
+    instrument = oscillograph(rm)
+    session = instrument.connect(sim.host, 'SOCKET', sim.port)
+
+    assert session is not None
+
+    yield instrument, session
+
+    session.close()
+    rm.close()
+
+
+#####################################################################
+# Batching
+#####################################################################
+def test_joinCommands_respects_line_length_and_common_commands():
+
+    instrument = oscillograph()
+    instrument.max_command_length = 20
+
+    lines = instrument._joinCommands(['CHAN1:STAT ON', '*CLS', 'TIM:SCAL 0.001', 'CHAN2:STAT ON'])
+
+    assert lines == ['CHAN1:STAT ON;*CLS', 'TIM:SCAL 0.001', 'CHAN2:STAT ON']
+    assert all(len(line) <= 20 for line in lines)
+
+
+def test_joinCommands_keeps_long_command_alone():
+
+    instrument = oscillograph()
+    instrument.max_command_length = 10
+
+    assert instrument._joinCommands(['A', 'B'*30, 'C']) == ['A', 'B'*30, 'C']
+
+
+def test_batch_sends_one_line(sim, scope):
+
+    instrument, session = scope
+
+    sim.resetCounters()
+
+    with instrument.batch(session):
+        instrument.setChannelState(session, 2, 1)
+        instrument.setHorizontal(session, 0.001)
+
+    assert sim.counters['messages'] == 1
+    assert sim.settings['CHAN2:STAT'] in ('ON', '1')
+    assert instrument.batch_errors == []
+
+
+@pytest.mark.parametrize('opc', [True, False])
+def test_batch_errors_are_assigned_to_commands(sim, scope, opc):
+
+    instrument, session = scope
+
+    with instrument.batch(session, opc):
+        instrument.setChannelState(session, 2, 1)
+        instrument.setChannelState(session, 7, 1)
+
+    # Error message contains ';' and must not be split
+    assert instrument.batch_errors == [('CHAN7:STAT ON', '-113,"Undefined header;CHAN7:STAT"')]
+    assert sim.errors == []
+    assert sim.settings['CHAN2:STAT'] in ('ON', '1')
+
+
+def test_batch_action_commands_are_not_replayed(sim, scope, monkeypatch):
+
+    instrument, session = scope
+    sent = []
+
+    send, ask = instrument._send, instrument._ask
+    monkeypatch.setattr(instrument, '_send', lambda session, line: sent.append(line) or send(session, line))
+    monkeypatch.setattr(instrument, '_ask', lambda session, line: sent.append(line) or ask(session, line))
+
+    with instrument.batch(session):
+        instrument._write(session, 'CHAN7:STAT ON')
+        instrument._write(session, 'RUNS')
+
+    # Error is logged without assignment, error queue is read out
+    assert sent[0] == 'CHAN7:STAT ON;:RUNS;*OPC?;:SYST:ERR?'
+    assert set(sent[1:]) == {'SYST:ERR?'}
+    assert instrument.batch_errors == []
+    assert sim.errors == []
+
+
+def test_batch_errors_raise_if_enabled(sim, scope):
+
+    instrument, session = scope
+    instrument.raise_batch_errors = True
+
+    with pytest.raises(RuntimeError, match='CHAN7:STAT'):
+        with instrument.batch(session):
+            instrument.setChannelState(session, 7, 1)
+
+    assert instrument.batch_errors == [('CHAN7:STAT ON', '-113,"Undefined header;CHAN7:STAT"')]
+
+
+#####################################################################
+# Synchronization
+#####################################################################
+def test_waitOperation_srq_falls_back_to_polling(sim, scope):
+
+    instrument, session = scope
+    instrument.use_srq = True
+
+    instrument.waitOperation(session, 'RUNS', 5)
+
+    assert sim.errors == []
+
+
+@pytest.mark.parametrize('use_srq', [False, True])
+def test_waitOperation_timeout(sim, scope, use_srq):
+
+    instrument, session = scope
+    instrument.use_srq = use_srq
+
+    sim.acquisition_time = 0.5
+
+    with pytest.raises(TimeoutError):
+        instrument.waitOperation(session, 'RUNS', 0.05)
+
+
+def test_statistics_timeout_restores_single_acquisition(sim, scope):
+
+    instrument, session = scope
+
+    with pytest.raises(TimeoutError):
+        instrument.getStatisticVpp(session, 1, 50, timeout=0.05)
+
+    assert sim.settings['ACQ:NSIN:COUN'] == '1'
+
+
+def test_segments_timeout_restores_acquisition(sim, scope):
+
+    instrument, session = scope
+
+    with pytest.raises(TimeoutError):
+        instrument.captureSegments(session, 1, 50, timeout=0.05)
+
+    assert sim.settings['ACQ:NSIN:COUN'] == '1'
+    assert sim.settings['ACQ:SEGM:STAT'] == 'OFF'
+
+
+#####################################################################
+# Autorange
+#####################################################################
+def _settle(ranger, amplitude):
+
+    scale = ranger.scale
+
+    while scale is not None:
+        scale = ranger.next(amplitude, amplitude >= 10 * ranger.scale)
+
+    return ranger
+
+
+@pytest.mark.parametrize('start', autorange.SCALES)
+@pytest.mark.parametrize('amplitude', [0.0005, 0.045, 0.3, 3.3, 12.0, 300.0])
+def test_autorange_converges_to_smallest_fitting_scale(start, amplitude):
+
+    ranger = _settle(autorange(start), amplitude)
+
+    assert not ranger.overrange
+    assert ranger.scale == autorange.SCALES[ranger.fit(amplitude)]
+    assert amplitude < 10 * ranger.scale * autorange.HEADROOM or ranger.scale == autorange.SCALES[-1]
+    assert ranger.steps <= len(autorange.SCALES)
+
+
+def test_autorange_overrange():
+
+    ranger = autorange(0.5)
+    scale = ranger.scale
+
+    while scale is not None:
+        scale = ranger.next(0.0, True)
+
+    assert ranger.overrange
+    assert ranger.scale == autorange.SCALES[-1]
+
+
+def test_getVoltage_settles_scale(sim, scope):
+
+    instrument, session = scope
+
+    assert instrument.getVoltage(session, 2) == pytest.approx(12.0, abs=0.1)
+    # Screen with offset 0 has to fit +/- 12 V
+    assert float(sim.settings['CHAN2:SCAL']) == autorange.SCALES[autorange(0.5).fit(24.0)]
+
+
+#####################################################################
+# Quick measure
+#####################################################################
+def test_quickMeas_overflow_flags():
+
+    result = quickMeas.parse('0.045,9.91E+37,-0.02,100000,1E-05,9.91E+37,3.3,3.3E-06,-9.91E+37')
+
+    assert result.overflow == (1 << 1) | (1 << 5) | (1 << 8)
+    assert result.valid('vpp') and result.valid('mean')
+    assert not result.valid('vp_upper') and not result.valid('rms') and not result.valid('fall')
+    assert result.astuple()[-1] == result.overflow
+
+
+def test_quickMeas_clipped_record_sets_all_flags(sim, scope):
+
+    instrument, session = scope
+
+    instrument.setQuickMeasState(session, 1)
+    instrument.setVertical(session, 1, 0.001)
+    instrument.acquireSingle(session)
+
+    result = instrument.getQuickMeasAll(session)
+
+    assert result.overflow == (1 << len(quickMeas.FIELDS)) - 1
+
+
+#####################################################################
+# Waveform download
+#####################################################################
+def _download(instrument, session, file_name, token):
+
+    head = instrument.downloadWaveform(session, 1, str(file_name), chunk_size=1000, resume_token=token)
+    head, raw = rtb2002.openWaveformFile(str(file_name))
+
+    return head, np.array(raw)
+
+
+def _interrupt(file_name, written):
+
+    head, raw = rtb2002.openWaveformFile(str(file_name), 'r+')
+    raw[written:] = 0
+    raw[:written] = 0xFF
+    raw.flush()
+    del raw
+
+    head['written'] = written
+    rtb2002._saveWaveformHeader(str(file_name), head)
+
+
+def test_downloadWaveform_resumes_with_same_token(scope, tmp_path):
+
+    instrument, session = scope
+    file_name = tmp_path / 'record.bin'
+
+    instrument.acquireSingle(session)
+
+    head, full = _download(instrument, session, file_name, 'run-1')
+
+    assert head['written'] == full.size
+    assert head['token'] == 'run-1'
+
+    _interrupt(file_name, 4000)
+
+    head, resumed = _download(instrument, session, file_name, 'run-1')
+
+    # Written part is kept, only rest is downloaded again
+    assert head['written'] == full.size
+    assert (resumed[:4000] == 0xFF).all()
+    assert (resumed[4000:] == full[4000:]).all()
+
+
+@pytest.mark.parametrize('token', [None, 'run-2'])
+def test_downloadWaveform_restarts_without_matching_token(scope, tmp_path, token):
+
+    instrument, session = scope
+    file_name = tmp_path / 'record.bin'
+
+    instrument.acquireSingle(session)
+
+    head, full = _download(instrument, session, file_name, 'run-1')
+
+    _interrupt(file_name, 4000)
+
+    head, again = _download(instrument, session, file_name, token)
+
+    assert (again == full).all()
+
+
+#####################################################################
+# Analysis
+#####################################################################
+def test_maskTest_matches_reference():
+
+    rng = np.random.default_rng(1)
+    volts = rng.normal(0.0, 0.02, (20, 500))
+    volts[3, 100] = 0.2
+    volts[7, 250:260] = -0.3
+
+    upper, lower = rtb2002_analysis.envelopeMask(np.zeros(500), 0.1)
+    result = rtb2002_analysis.maskTest(volts, upper, lower)
+
+    margin = np.minimum(upper - volts, volts - lower)
+
+    assert np.allclose(result['margin'], margin.min(axis=1))
+    assert (result['worst'] == margin.argmin(axis=1)).all()
+    assert (result['violations'] == (margin < 0).sum(axis=1)).all()
+    assert list(np.flatnonzero(~result['passed'])) == [3, 7]
+    assert result['first'][3] == 100 and result['first'][7] == 250
+    assert (result['first'][result['passed']] == -1).all()
+
+
+def test_maskTest_one_sided():
+
+    volts = np.array([[0.0, 0.5, 1.5], [0.0, 0.1, 0.2]])
+
+    assert list(rtb2002_analysis.maskTest(volts, upper=1.0)['passed']) == [False, True]
+    assert list(rtb2002_analysis.maskTest(volts, lower=0.05)['violations']) == [1, 1]
+
+    with pytest.raises(ValueError):
+        rtb2002_analysis.maskTest(volts)
+
+
+def test_psd_parseval_and_dominant_frequency():
+
+    step = 1e-6
+    xtime = np.arange(4096) * step
+    volts = np.vstack([0.1 * np.sin(2 * np.pi * 12.3e3 * xtime), 0.05 * np.sin(2 * np.pi * 40e3 * xtime) + 1.0])
+
+    freq, power = rtb2002_analysis.psd(xtime, volts, 'rect')
+
+    # Power of one-sided PSD equals variance of waveform
+    assert np.allclose(power.sum(axis=1) * (freq[1] - freq[0]), volts.var(axis=1), rtol=1e-3)
+
+    freq, power = rtb2002_analysis.psd(xtime, volts, 'hann')
+
+    assert np.allclose(rtb2002_analysis.dominantFrequency(freq, power), [12.3e3, 40e3], rtol=5e-3)
+
+    rms = rtb2002_analysis.bandRMS(freq, power, [(5e3, 20e3), (30e3, 50e3)])
+
+    assert rms[0, 0] == pytest.approx(0.1 / np.sqrt(2), rel=0.05)
+    assert rms[1, 1] == pytest.approx(0.05 / np.sqrt(2), rel=0.05)
+    assert rms[0, 1] < 0.01 and rms[1, 0] < 0.01
+
+
+#####################################################################
+# Command line
+#####################################################################
+def _strict(constant):
+
+    raise ValueError("Not JSON: "+constant)
+
+
+def _runJobs(tmp_path, measurements, instruments=('a', 'b')):
+
+    job_file = tmp_path / 'jobs.json'
+    job_file.write_text(json.dumps({'instruments': list(instruments), 'measurements': measurements}))
+
+    output = tmp_path / 'results.jsonl'
+    code = rtb2002.main([str(job_file), '--dry-run', '-t', 'HISLIP', '-w', '2', '-o', str(output)])
+
+    return code, [json.loads(line, parse_constant=_strict) for line in output.read_text().splitlines()]
+
+
+def test_cli_dry_run(tmp_path):
+
+    code, records = _runJobs(tmp_path, [
+        {'name': '3V3', 'method': 'getVoltage', 'args': [1]},
+        {'name': 'stats', 'method': 'getChannelStats', 'args': [[1, 3]]},
+    ])
+
+    assert code == 0
+    assert len(records) == 4
+    assert sorted(record['address'] for record in records) == ['a', 'a', 'b', 'b']
+    assert all(record['error'] is None for record in records)
+
+    for record in records:
+        if record['name'] == '3V3':
+            assert record['result'] == pytest.approx(3.3, abs=0.1)
+        else:
+            # Flat channel has no frequency (NaN -> null)
+            assert record['result']['3']['frequency'] is None
+
+
+def test_cli_rejected_setup_fails(tmp_path):
+
+    code, records = _runJobs(tmp_path, [
+        {'method': 'getVoltage', 'args': [7]},
+        {'method': 'getVoltage', 'args': [1]},
+    ], ['a'])
+
+    assert code == 1
+    assert 'CHAN7' in records[0]['error'] and records[0]['result'] is None
+    assert records[1]['error'] is None
+
+
+def test_cli_unknown_method(tmp_path):
+
+    with pytest.raises(SystemExit):
+        _runJobs(tmp_path, [{'method': '_write', 'args': ['*RST']}])